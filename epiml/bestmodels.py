@@ -7,9 +7,6 @@ This module contains all (err some) of the best models from the project
 """
 
 from sklearn.ensemble import RandomForestClassifier
-from sklearn.preprocessing import MaxAbsScaler
-from sklearn.svm import SVC
-from sklearn.pipeline import Pipeline
 
 from epiml.epimlsklearn.repeatedsampling import RepeatedRandomSubSampler
 from epiml.epimlsklearn.pnuwrapper import PNUWrapper
@@ -59,6 +56,9 @@ def generate_best_svc(svc_random_state=551, pnu_random_state=721):
 
     It was found using 3x3 nested cross validation for 20 random iterations optimized to f1 beta=10 on all data
     """
+    from sklearn.preprocessing import MaxAbsScaler
+    from sklearn.svm import SVC
+    from sklearn.pipeline import Pipeline
     estimators = [('scaler', MaxAbsScaler()),
               ('clf',PNUWrapper(base_estimator=SVC(C=7.1311952396509097, gamma='auto', kernel='linear',
                                                    probability=True, class_weight='balanced',
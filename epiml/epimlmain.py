@@ -7,35 +7,74 @@ This class will represent utilities to save / load models
 as well as an entry-point to run further models with new input data.
 """
 
+import argparse
 from collections import namedtuple
+from itertools import islice
+
+import numpy as np
 import pandas as pd
 
 from sklearn.exceptions import NotFittedError, ChangedBehaviorWarning
-from sklearn.model_selection import train_test_split
 from sklearn.externals import joblib
-from sklearn.pipeline import Pipeline
+from sklearn.externals.joblib import Parallel, delayed, cpu_count
+
+from epiml.loadepiml import LoadEpiml, iter_epiml_chunks
+from epiml.epimlsklearn.leanmodel import without_training_data
+from epiml.predictioncache import model_fingerprint, row_keys
 
-from epiml.loadepiml import LoadEpiml
-from epiml.bestmodels import generate_model_6
+# Training imports (model definitions, pipelines, splitting) and the flat model exporter are deferred to the methods
+# that use them so loading a model and scoring with it stays fast to start.  For the leanest scoring-only path
+# see epiml.scoring
 
-def save_clf(clf, filename):
+def save_clf(clf, filename, lean=False):
     """
     Save a classifier to disk in a pickle file using joblib
+    If lean, the training data copies kept by every fitted PNUWrapper / RepeatedRandomSubSampler are left out
     """
-    joblib.dump(clf, filename, compress=True)
+    if lean:
+        with without_training_data(clf):
+            joblib.dump(clf, filename, compress=True)
+    else:
+        joblib.dump(clf, filename, compress=True)
 
 def load_clf(filename):
     return joblib.load(filename)
 
+def _score_chunk(clf, X):
+    return clf.predict_proba(X)[:,-1]
+
+def _score_cached(clf, X, cache, fingerprint, id_col=None):
+    """ Score X with clf, only sending rows that are not in the PredictionCache through the final estimator """
+    ids = X[id_col].values if id_col is not None and id_col in X.columns else None
+    Xt = X
+    for _, step in clf.steps[:-1]:
+        Xt = step.transform(Xt)
+    keys = row_keys(Xt, ids)
+    probas = cache.get(fingerprint, keys)
+    missing = np.flatnonzero(np.isnan(probas))
+    if len(missing) > 0:
+        Xt_missing = Xt.iloc[missing] if isinstance(Xt, pd.DataFrame) else Xt[missing]
+        probas[missing] = clf.steps[-1][1].predict_proba(Xt_missing)[:,-1]
+        cache.put(fingerprint, [keys[i] for i in missing], probas[missing])
+    return probas
+
 class EpimlModel:
 
     ClassifierAndData = namedtuple('ClassifierAndData', 'clf X_train X_test y_train y_test')
 
     def __init__(self):
         self.clf = None
+        self._fingerprint = None
         return
 
-    def generate_trained_model(self, path: str, sep='\t', generate_clf_fn=generate_model_6, **kwargs):
+    def fingerprint(self):
+        """ Hash of the current model, used to key a PredictionCache.  Computed once per model """
+        if self._fingerprint is None:
+            self._fingerprint = model_fingerprint(self.clf)
+        return self._fingerprint
+
+    def generate_trained_model(self, path: str, sep='\t', generate_clf_fn=None, chunksize=None,
+                               cache_dir=None, **kwargs):
         """Generate a trained model for EpimlnModel from a file with data as specified in LoadEpiml
 
         Parameters:
@@ -44,23 +83,33 @@ class EpimlModel:
             filepath of data to open in LoadEpiml
         sep: char, optional, default='\t'
             seperator character for the file path passed in
-        generate_clf_fn: function that generates a classifier, optional, default=bestmodels.generate_model_6
+        generate_clf_fn: function that generates a classifier, optional, default=None
             Use this to generate a model to be trained and passed data from files like found in "path"
+            If None, bestmodels.generate_model_6 is used
+        chunksize: int, optional, default=None
+            If set, LoadEpiml streams the file in chunks of this many rows with downcast dtypes
+        cache_dir: str, optional, default=None
+            If set, LoadEpiml caches the parsed file under this directory and reuses it on later calls
         kwargs: keyword args passed to generate_model_6
 
         Returns:
         ------------------
         Pipeline classifier that ties LoadEpiml to the GeneratedModel, after setting self.clf to it
         """
-        lc = LoadEpiml(path, sep=sep, call_fit=False)
+        from sklearn.pipeline import Pipeline
+        if generate_clf_fn is None:
+            from epiml.bestmodels import generate_model_6 as generate_clf_fn
+        lc = LoadEpiml(path, sep=sep, call_fit=False, chunksize=chunksize, cache_dir=cache_dir)
         clf = generate_clf_fn(**kwargs)
         pipe = Pipeline([('lc',lc.transformer),('model',clf)])
         pipe.fit(lc.data, lc.y)
         self.clf = pipe
+        self._fingerprint = None
         return self.clf
 
-    def generate_trained_model_with_split(self, path: str, sep='\t', generate_clf_fn=generate_model_6,
-                                          test_size=0.2, random_state=771, **kwargs):
+    def generate_trained_model_with_split(self, path: str, sep='\t', generate_clf_fn=None,
+                                          test_size=0.2, random_state=771, chunksize=None, cache_dir=None,
+                                          **kwargs):
         """Generate a trained model on a portion of the data passed in
 
         Parameters:
@@ -69,29 +118,71 @@ class EpimlModel:
             filepath of data to open in LoadEpiml
         sep: char, optional, default='\t'
             seperator character for the file path passed in
-        generate_clf_fn: function that generates a classifier, optional, default=bestmodels.generate_model_6
+        generate_clf_fn: function that generates a classifier, optional, default=None
             Use this to generate a model to be trained and passed data from files like found in "path"
+            If None, bestmodels.generate_model_6 is used
         test_size: float, optional, default=0.0
             real number between 0 and 1 that represents the percentage of the data to use for testing
             If 0, then use ALL training data to train the model
         random_state: int, optional, default=771
             Used as a random seed to split up training and testing data if desired
+        chunksize: int, optional, default=None
+            If set, LoadEpiml streams the file in chunks of this many rows with downcast dtypes
+        cache_dir: str, optional, default=None
+            If set, LoadEpiml caches the parsed file under this directory and reuses it on later calls
         kwargs: keyword args passed to generate_model_6
 
         Returns:
         --------------------------------------
         ClassifierAndData named tuple with all the data to train the classfier and the classifier itself
         """
-        lc = LoadEpiml(path, sep=sep, call_fit=False)
+        from sklearn.pipeline import Pipeline
+        if generate_clf_fn is None:
+            from epiml.bestmodels import generate_model_6 as generate_clf_fn
+        lc = LoadEpiml(path, sep=sep, call_fit=False, chunksize=chunksize, cache_dir=cache_dir)
         clf = generate_clf_fn(**kwargs)
+        from sklearn.model_selection import train_test_split
         pipe = Pipeline([('lc',lc.transformer),('model',clf)])
         X_train, X_test, y_train, y_test = train_test_split(lc.data, lc.y, test_size=test_size,
                                                             random_state=random_state, stratify=lc.y)
         pipe.fit(X_train, y_train)
         self.clf = pipe
+        self._fingerprint = None
         res = self.ClassifierAndData(clf=pipe, X_train=X_train, X_test=X_test, y_train=y_train, y_test=y_test)
         return res
 
+    def update_trained_model(self, path: str, sep='\t', max_age=None, chunksize=None, cache_dir=None):
+        """Incrementally retrain the model with new data instead of regenerating it from scratch
+
+        Only models whose final step has an update method can be updated, like model 6 (PNUWrapper of a
+        RepeatedRandomSubSampler): new sub-estimators are trained on the new unlabeled members while the existing ones
+        are kept (or retired by max_age).  The transformer's columns are not refit.
+
+        Parameters:
+        --------------------
+        path: str, required
+            filepath of data to open in LoadEpiml with the new members (unlabeled / negatives) and EVERY current
+            positive, old and new
+        sep: char, optional, default='\t'
+            seperator character for the file path passed in
+        max_age: int, optional, default=None
+            retire sub-estimators trained more than max_age updates ago, see RepeatedRandomSubSampler.update
+        chunksize, cache_dir: see generate_trained_model
+
+        Returns:
+        ------------------
+        the updated Pipeline classifier, self.clf
+        """
+        if self.clf is None:
+            raise NotFittedError("EpimlModel not generated or loaded. Please call generate_trained_model or load_model")
+        lc = LoadEpiml(path, sep=sep, call_fit=False, chunksize=chunksize, cache_dir=cache_dir)
+        X = lc.data
+        for _, step in self.clf.steps[:-1]:
+            X = step.transform(X)
+        self.clf.steps[-1][1].update(X, lc.y.values, max_age=max_age)
+        self._fingerprint = None
+        return self.clf
+
     def load_model(self, model_path: str):
         """ Load a model from disk and set self.clf to it
 
@@ -107,16 +198,30 @@ class EpimlModel:
         if self.clf is not None:
             raise ChangedBehaviorWarning("EpimlModel being loaded is overwriting another model")
         self.clf = load_clf(model_path)
+        self._fingerprint = None
         return self.clf
 
-    def save_model(self, model_path: str):
+    def save_model(self, model_path: str, lean=True):
         """ Save the model to model_path using joblib
+
+        lean: Boolean, optional, default=True
+            If true, leave out the copies of the training data the fitted model holds (see save_clf)
+        """
+        if self.clf is None:
+            raise NotFittedError("Cannot save a model that hasn't been created or trained yet")
+        save_clf(self.clf, model_path, lean=lean)
+
+    def save_flat_model(self, folder: str):
+        """ Export the model to folder as flat, memory-mappable tree arrays (see flatmodel.export_flat_model).
+        Load it with flatmodel.load_flat_model for fast starting scoring jobs
         """
         if self.clf is None:
             raise NotFittedError("Cannot save a model that hasn't been created or trained yet")
-        save_clf(self.clf, model_path)
+        from epiml.flatmodel import export_flat_model
+        export_flat_model(self.clf, folder)
 
-    def predict(self, path: str=None, sep='\t', X: pd.DataFrame=None):
+    def predict(self, path: str=None, sep='\t', X: pd.DataFrame=None, chunksize=None,
+                cache_dir=None, cache=None, id_col=None):
         """Predict a file of data or X in the same shape as the model is fitted with returning an Array of probabilities
         Of if EPI is true
 
@@ -126,10 +231,20 @@ class EpimlModel:
             If set, X must be None. Will open this file using LoadEpiml and send it through self.clf
             It must be the same as what the model was trained with
             "unlabel_flag", "true_pos_flag", and "true_neg_flag" must be set
+            To score files without these columns, or too large to fit in memory, use predict_to_file
         X: pd.DataFrame, optional, default=None
             If set, path must be None
             It must have the same column names as the file used to train the model originally
             Will be sent through the self.clf pipeline
+        chunksize: int, optional, default=None
+            If set along with path, LoadEpiml streams the file in chunks of this many rows with downcast dtypes
+        cache_dir: str, optional, default=None
+            If set along with path, LoadEpiml caches the parsed file under this directory and reuses it later
+        cache: PredictionCache, optional, default=None
+            If set, rows whose transformed features were already scored by this same model are read from the cache
+            and only new or changed rows go through the model
+        id_col: str, optional, default=None
+            If set along with cache, also key cached predictions by this column (ie 'MemberID')
 
         Returns:
         -----------------------------
@@ -143,11 +258,89 @@ class EpimlModel:
             raise NotFittedError("EpimlModel not generated or loaded. Please call generate_trained_model or load_model")
         if path is not None:
             #note that the file needs the columns "unlabel_flag", "true_pos_flag" and "true_neg_flag" defined
-            lc = LoadEpiml(path, sep=sep, call_fit=False)
+            lc = LoadEpiml(path, sep=sep, call_fit=False, chunksize=chunksize, cache_dir=cache_dir)
             X = lc.data.copy()
         else:
             X = X.copy()
+        if cache is not None:
+            return _score_cached(self.clf, X, cache, self.fingerprint(), id_col=id_col)
         return self.clf.predict_proba(X)[:,-1]
 
+    def predict_to_file(self, path: str, output_path: str, sep='\t', chunksize=100000, n_jobs=1, id_col='MemberID',
+                        cache=None):
+        """Score a file of data in chunks, writing "id_col, probability" rows to output_path as each chunk is scored
+
+        Memory use is bounded by n_jobs chunks at a time no matter how large the file is.  Unlike predict, the file
+        does not need the "unlabel_flag", "true_pos_flag" or "true_neg_flag" columns, so new members can be scored.
+
+        Parameters:
+        -----------------------------
+        path: str, required
+            file with the same columns as what the model was trained with, except the label flag columns
+        output_path: str, required
+            file to write scores to, delimited by sep with a header row
+        sep: char, optional, default='\t'
+            seperator character of the input and output files
+        chunksize: int, optional, default=100000
+            number of rows scored at a time
+        n_jobs: int, optional, default=1
+            number of chunks scored in parallel (threads, so the model is shared and not copied), -1 for all cores
+        id_col: str, optional, default='MemberID'
+            column of the input file written next to each probability
+        cache: PredictionCache, optional, default=None
+            If set, only rows not already scored by this model (keyed by features and id_col) go through the model.
+            Cache lookups run one chunk at a time, so n_jobs is ignored
+
+        Returns:
+        -----------------------------
+        number of rows scored
+        """
+        if self.clf is None:
+            raise NotFittedError("EpimlModel not generated or loaded. Please call generate_trained_model or load_model")
+        n_parallel = n_jobs if n_jobs > 0 else max(cpu_count() + 1 + n_jobs, 1)
+        chunks = iter_epiml_chunks(path, sep=sep, chunksize=chunksize)
+        n_rows = 0
+        with open(output_path, 'w') as f, Parallel(n_jobs=n_jobs, backend='threading') as parallel:
+            f.write("{}{}{}\n".format(id_col, sep, 'probability'))
+            while True:
+                window = list(islice(chunks, n_parallel))
+                if len(window) == 0:
+                    break
+                for chunk in window:
+                    if id_col not in chunk.columns:
+                        raise ValueError("{} does not have an id column {}".format(path, id_col))
+                if cache is not None:
+                    probas = [_score_cached(self.clf, chunk, cache, self.fingerprint(), id_col=id_col)
+                              for chunk in window]
+                else:
+                    probas = parallel(delayed(_score_chunk)(self.clf, chunk) for chunk in window)
+                for chunk, proba in zip(window, probas):
+                    scores = pd.DataFrame({id_col: chunk[id_col].values, 'probability': proba},
+                                          columns=[id_col, 'probability'])
+                    scores.to_csv(f, sep=sep, header=False, index=False)
+                    n_rows += len(scores)
+        return n_rows
+
+def main(argv=None):
+    """ Command line entry point to batch score a file with a saved model:
+
+        python -m epiml.epimlmain model.pkl membership.txt scores.txt --chunksize 100000 --n-jobs 4
+    """
+    parser = argparse.ArgumentParser(description="Score a membership file with a saved EpimlModel")
+    parser.add_argument('model_path', help="model saved with EpimlModel.save_model")
+    parser.add_argument('path', help="delimited file of members to score")
+    parser.add_argument('output_path', help="file to write MemberID, probability rows to")
+    parser.add_argument('--sep', default='\t', help="delimiter of the input and output files, tab by default")
+    parser.add_argument('--chunksize', type=int, default=100000, help="rows scored at a time")
+    parser.add_argument('--n-jobs', type=int, default=1, help="chunks scored in parallel")
+    parser.add_argument('--id-col', default='MemberID', help="id column written next to each probability")
+    args = parser.parse_args(argv)
 
+    model = EpimlModel()
+    model.load_model(args.model_path)
+    n_rows = model.predict_to_file(args.path, args.output_path, sep=args.sep, chunksize=args.chunksize,
+                                   n_jobs=args.n_jobs, id_col=args.id_col)
+    print("Scored {} rows from {} to {}".format(n_rows, args.path, args.output_path))
 
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,138 @@
+# -*- coding: utf-8 -*-
+"""
+Post-fit pruning of RepeatedRandomSubSampler ensembles: keep the fewest sub-estimators (and trees inside each forest)
+whose validation score stays close to the full ensemble's, or that fit a per-row latency budget
+"""
+
+import time
+
+import numpy as np
+
+from .epimlmetrics import pu_mix_assumed_f1beta10
+
+
+def _unwrap(clf, X):
+    """ Return the final estimator of clf, the subsampler inside it (clf is a RepeatedRandomSubSampler, PNUWrapper or a
+    Pipeline ending in either), X transformed by any pipeline steps before it and the probability threshold class 1
+    is predicted with """
+    if hasattr(clf, 'steps'):
+        for _, step in clf.steps[:-1]:
+            X = step.transform(X)
+        clf = clf.steps[-1][1]
+    final = clf
+    threshold = getattr(clf, 'threshold_', None)
+    if hasattr(clf, 'base_estimator') and not hasattr(clf, 'estimators_'):
+        clf = clf.base_estimator
+    if not hasattr(clf, 'estimators_') or not hasattr(clf, 'voting'):
+        raise ValueError("prune_ensemble needs a fitted RepeatedRandomSubSampler, got {}".format(clf))
+    if clf.voting == 'hard':
+        raise ValueError("prune_ensemble only supports voting in ('soft', 'thresh')")
+    if threshold is None:
+        threshold = clf.binary_thresh if clf.voting == 'thresh' else 0.5
+    return final, clf, X, threshold
+
+def _timed_proba(estimator, X):
+    """ Probability of class 1 of estimator on X and the seconds it took per row """
+    start = time.perf_counter()
+    proba = estimator.predict_proba(X)[:, -1]
+    return proba, (time.perf_counter() - start) / X.shape[0]
+
+def prune_ensemble(clf, X_val, y_val, tol=0.01, max_row_latency=None, prune_trees=False, verbose=0):
+    """ Greedily prune the sub-estimators of a fitted RepeatedRandomSubSampler (in place) on a validation set.
+
+    Every sub-estimator's probabilities on X_val are computed once.  Starting from an empty ensemble, the
+    sub-estimator that most improves pu_mix_assumed_f1beta10 of the averaged ensemble is added until the score is
+    within tol of the full ensemble's.  With max_row_latency, adding stops before the measured predict_proba time per
+    row would exceed it, keeping the best scoring ensemble seen.  With prune_trees, every kept forest then keeps
+    only the first k of its trees, the smallest k keeping the ensemble score within tol of the full ensemble's.
+
+    Parameters
+    ----------
+    clf : a fitted RepeatedRandomSubSampler, PNUWrapper around one or Pipeline ending in either.  Labels are
+        decided with the PNUWrapper's threshold_ when set, else binary_thresh ('thresh') or 0.5 ('soft')
+    X_val, y_val : validation data, y_val uses -1 for unlabeled, 0 negative and 1 positive
+    tol : float, optional, default=0.01
+        Allowed drop in validation pu_mix_assumed_f1beta10 from the full ensemble
+    max_row_latency : float or None, optional, default=None
+        Per-row predict_proba budget in seconds of the pruned ensemble, measured on X_val
+    prune_trees : bool, optional, default=False
+        Also drop trees from the end of every kept forest (sub-estimators with estimators_)
+
+    Returns
+    -------
+    dict with the number of members and scores before and after and the estimated per-row latency after
+    """
+    final, sampler, X_val, threshold = _unwrap(clf, X_val)
+    y_val = np.asarray(y_val)
+
+    def score(proba):
+        return pu_mix_assumed_f1beta10(y_val, (proba >= threshold).astype(int))
+
+    members = list(sampler.estimators_)
+    probas, latencies = zip(*[_timed_proba(estimator, X_val) for estimator in members])
+    probas = np.asarray(probas)
+    latencies = np.asarray(latencies)
+    full_score = score(probas.mean(axis=0))
+    target = full_score - tol
+
+    selected = []
+    total = np.zeros(X_val.shape[0], dtype=np.float64)
+    best_score, best_selected = -np.inf, []
+    remaining = list(range(len(members)))
+    while remaining:
+        if max_row_latency is not None:
+            remaining = [i for i in remaining if latencies[selected].sum() + latencies[i] <= max_row_latency]
+            if not remaining:
+                break
+        scores = [score((total + probas[i]) / (len(selected) + 1)) for i in remaining]
+        pick = remaining.pop(int(np.argmax(scores)))
+        selected.append(pick)
+        total += probas[pick]
+        if max(scores) > best_score:
+            best_score, best_selected = max(scores), list(selected)
+        if verbose > 0:
+            print("{} members, score {:.4f} (full ensemble {:.4f})".format(len(selected), max(scores), full_score))
+        if max(scores) >= target:
+            break
+    if not best_selected:
+        raise ValueError("max_row_latency={} is below the latency of any single sub-estimator ({:.3g})".format(
+                         max_row_latency, latencies.min()))
+    selected = best_selected
+    pruned_score = best_score
+    row_latency = latencies[selected].sum()
+
+    if prune_trees:
+        total = probas[selected].sum(axis=0)
+        for i in selected:
+            forest = members[i]
+            if not hasattr(forest, 'estimators_'):
+                continue
+            trees = forest.estimators_
+            tree_probas = np.cumsum([tree.predict_proba(X_val)[:, -1] for tree in trees], axis=0)
+            others = total - probas[i]
+            for k in range(1, len(trees) + 1):
+                candidate = tree_probas[k - 1] / k
+                candidate_score = score((others + candidate) / len(selected))
+                if candidate_score >= min(target, pruned_score):
+                    break
+            forest.estimators_ = trees[:k]
+            row_latency -= latencies[i] * (1 - k / len(trees))
+            total = others + candidate
+            pruned_score = candidate_score
+            if verbose > 0:
+                print("member {} keeps {} of {} trees, score {:.4f}".format(i, k, len(trees), pruned_score))
+
+    n_before = len(members)
+    selected = sorted(selected)
+    sampler.estimators_ = [members[i] for i in selected]
+    for attr in ('estimator_generations_', 'samples_indices_'):
+        if hasattr(sampler, attr) and len(getattr(sampler, attr)) == n_before:
+            setattr(sampler, attr, [getattr(sampler, attr)[i] for i in selected])
+    # the compiled engine and out-of-bag estimate describe the unpruned ensemble
+    sampler._drop_engine()
+    for obj in (sampler, final):
+        for attr in ('oob_decision_function_', 'oob_score_'):
+            vars(obj).pop(attr, None)
+
+    return {'n_members_before': n_before, 'n_members': len(selected), 'full_score': full_score,
+            'score': pruned_score, 'row_latency': row_latency}
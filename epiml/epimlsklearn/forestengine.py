@@ -0,0 +1,122 @@
+# -*- coding: utf-8 -*-
+"""
+A batch inference engine for tree ensembles (forests, and RepeatedRandomSubSampler ensembles of forests).
+
+Every tree of the ensemble is merged into one set of flat node arrays and a batch of rows is pushed through all trees
+at once, one tree level per numpy step (level-synchronous traversal), instead of calling predict_proba on every
+sub-estimator and every tree in Python.
+"""
+
+import numpy as np
+from scipy.sparse import issparse
+
+__all__ = ["CompiledForest", "flatten_trees"]
+
+
+def _collect_trees(estimator, weight=1.0):
+    """ Return a list of (sklearn Tree, weight) where predict_proba of estimator is sum(weight * tree proba) """
+    if hasattr(estimator, 'tree_'):
+        return [(estimator.tree_, weight)]
+    if hasattr(estimator, 'estimators_'):
+        if getattr(estimator, 'voting', 'soft') == 'hard':
+            raise ValueError("Only averaged probabilities can be flattened, {} uses hard voting".format(estimator))
+        trees = []
+        for sub_estimator in estimator.estimators_:
+            trees.extend(_collect_trees(sub_estimator, weight / len(estimator.estimators_)))
+        return trees
+    if hasattr(estimator, 'base_estimator'):
+        return _collect_trees(estimator.base_estimator, weight)
+    raise ValueError("Don't know how to flatten {}".format(estimator))
+
+def flatten_trees(estimator):
+    """ Flatten the trees of a fitted tree ensemble into contiguous node arrays
+
+    Returns a dict of arrays:
+        feature, threshold: split of every node, a row goes left if X[feature] <= threshold
+        left, right: global node index of each child, -1 for leaves
+        value: class probabilities of every node (only read at leaves)
+        tree_offsets: node index of the root of each tree, and the total number of nodes at the end
+        tree_weights: weight of each tree's probabilities in the ensemble's averaged probability
+    """
+    trees = _collect_trees(estimator)
+    n_nodes = [tree.node_count for tree, _ in trees]
+    tree_offsets = np.concatenate(([0], np.cumsum(n_nodes))).astype(np.int64)
+    feature, threshold, left, right, value = [], [], [], [], []
+    for (tree, _), offset in zip(trees, tree_offsets):
+        is_leaf = tree.children_left == -1
+        feature.append(np.where(is_leaf, 0, tree.feature).astype(np.int32))
+        threshold.append(tree.threshold.astype(np.float64))
+        left.append(np.where(is_leaf, -1, tree.children_left + offset).astype(np.int64))
+        right.append(np.where(is_leaf, -1, tree.children_right + offset).astype(np.int64))
+        proba = tree.value[:, 0, :].astype(np.float64)
+        normalizer = proba.sum(axis=1)[:, np.newaxis]
+        normalizer[normalizer == 0.0] = 1.0
+        value.append(proba / normalizer)
+    return {'feature': np.concatenate(feature),
+            'threshold': np.concatenate(threshold),
+            'left': np.concatenate(left),
+            'right': np.concatenate(right),
+            'value': np.concatenate(value),
+            'tree_offsets': tree_offsets,
+            'tree_weights': np.asarray([weight for _, weight in trees], dtype=np.float64)}
+
+
+class CompiledForest:
+    """ All trees of an ensemble merged into flat arrays (see flatten_trees) with a vectorized predict_proba
+
+    predict_proba gives the same averaged probabilities as the estimator it was built from
+    """
+
+    def __init__(self, feature, threshold, left, right, value, tree_offsets, tree_weights, max_cells=2 ** 22):
+        """
+        max_cells: rows * trees traversed per numpy step, batches of rows are sized so memory stays around
+            max_cells * (value.shape[1] + 3) * 8 bytes
+        """
+        self.feature = feature
+        self.threshold = threshold
+        self.left = left
+        self.right = right
+        self.value = value
+        self.tree_offsets = tree_offsets
+        self.tree_weights = tree_weights
+        self.max_cells = max_cells
+
+    @classmethod
+    def from_estimator(cls, estimator, max_cells=2 ** 22):
+        """ Compile a fitted tree, forest, RepeatedRandomSubSampler of forests or PNUWrapper of those """
+        return cls(max_cells=max_cells, **flatten_trees(estimator))
+
+    @property
+    def n_trees(self):
+        return len(self.tree_weights)
+
+    def apply(self, X):
+        """ Return the global leaf node index reached by every row in every tree, shape [n_rows, n_trees] """
+        X = np.asarray(X, dtype=np.float32)
+        n_rows = X.shape[0]
+        roots = self.tree_offsets[:-1]
+        nodes = np.tile(roots, n_rows)
+        rows = np.repeat(np.arange(n_rows), self.n_trees)
+        active = np.flatnonzero(self.left[nodes] != -1)
+        # every step moves all (row, tree) pairs not yet at a leaf down one level
+        while active.size > 0:
+            active_nodes = nodes[active]
+            go_left = X[rows[active], self.feature[active_nodes]] <= self.threshold[active_nodes]
+            active_nodes = np.where(go_left, self.left[active_nodes], self.right[active_nodes])
+            nodes[active] = active_nodes
+            active = active[self.left[active_nodes] != -1]
+        return nodes.reshape(n_rows, self.n_trees)
+
+    def predict_proba(self, X):
+        n_rows = X.shape[0]
+        n_classes = self.value.shape[1]
+        proba = np.empty((n_rows, n_classes), dtype=np.float64)
+        batch_size = max(1, self.max_cells // max(self.n_trees, 1))
+        for start in range(0, n_rows, batch_size):
+            stop = min(start + batch_size, n_rows)
+            X_batch = X[start:stop]
+            if issparse(X_batch):
+                X_batch = X_batch.toarray()
+            leaves = self.apply(X_batch)
+            proba[start:stop] = np.einsum('rtc,t->rc', self.value[leaves], self.tree_weights)
+        return proba
@@ -0,0 +1,504 @@
+# -*- coding: utf-8 -*-
+"""
+A histogram based decision tree for RandomForestSubsample(splitter='hist').
+
+Features are binned once per forest into uint8 codes (HistogramBinner), then every tree finds its splits from
+(node, feature, bin, class) weight histograms instead of sorting feature values.  A tree grows one level at a time,
+the histograms and split search of all nodes of a level are a handful of bincounts and array operations per group of
+features with the same number of bins.  Split thresholds are stored in the original feature units, so fitted trees
+predict on raw X and look like sklearn trees to the forest, flatten_trees and CompiledForest.
+"""
+
+import numbers
+
+import numpy as np
+from scipy.sparse import issparse
+
+from sklearn.base import BaseEstimator, ClassifierMixin
+from sklearn.utils import check_random_state, check_array
+from sklearn.utils.validation import check_is_fitted
+from sklearn.tree._tree import DTYPE
+
+__all__ = ["HistogramBinner", "HistogramTreeClassifier"]
+
+TREE_LEAF = -1
+TREE_UNDEFINED = -2
+# (row, feature) entries binned at once, and histogram cells held at once, while growing a level
+_MAX_ENTRIES = 2 ** 20
+
+
+class HistogramBinner:
+    """ Map every feature to at most max_bins uint8 codes.
+
+    A feature with at most max_bins distinct values gets one bin per value, otherwise the bins are quantiles.  The
+    edges between bins are midpoints between consecutive values, and a value's code is the number of edges below it,
+    so code <= b is the same as value <= bin_edges_[feature][b].
+    """
+
+    def __init__(self, max_bins=255):
+        if not 2 <= max_bins <= 256:
+            raise ValueError("max_bins must be between 2 and 256, got {}".format(max_bins))
+        self.max_bins = max_bins
+
+    def fit(self, X):
+        X = check_array(X, dtype=DTYPE)
+        self.bin_edges_ = []
+        for column in X.T:
+            values = np.unique(column)
+            if len(values) > self.max_bins:
+                quantiles = np.percentile(column, np.linspace(0, 100, self.max_bins + 1)[1:-1],
+                                          interpolation='lower')
+                values = np.unique(np.concatenate((quantiles, values[-1:])))
+            values = values.astype(np.float64)
+            self.bin_edges_.append((values[:-1] + values[1:]) / 2.0)
+        self.n_bins_ = np.asarray([len(edges) + 1 for edges in self.bin_edges_], dtype=np.intp)
+        return self
+
+    def transform(self, X):
+        X = check_array(X, dtype=DTYPE)
+        codes = np.empty(X.shape, dtype=np.uint8, order='F')
+        for j, edges in enumerate(self.bin_edges_):
+            codes[:, j] = np.searchsorted(edges, X[:, j], side='left')
+        return codes
+
+
+class _HistTree:
+    """ The fitted node arrays, with the attribute names of sklearn.tree._tree.Tree """
+
+    def __init__(self, n_features, n_classes, children_left, children_right, feature, threshold, value, impurity,
+                 n_node_samples, weighted_n_node_samples, max_depth):
+        self.n_features = n_features
+        self.n_classes = np.asarray([n_classes], dtype=np.intp)
+        self.n_outputs = 1
+        self.children_left = children_left
+        self.children_right = children_right
+        self.feature = feature
+        self.threshold = threshold
+        self.value = value
+        self.impurity = impurity
+        self.n_node_samples = n_node_samples
+        self.weighted_n_node_samples = weighted_n_node_samples
+        self.node_count = len(children_left)
+        self.max_depth = max_depth
+
+    def apply(self, X):
+        """ Leaf index of every row of dense X, all rows descend one level per numpy step """
+        leaves = np.zeros(X.shape[0], dtype=np.intp)
+        rows = np.arange(X.shape[0])
+        while rows.size:
+            nodes = leaves[rows]
+            internal = self.children_left[nodes] != TREE_LEAF
+            rows, nodes = rows[internal], nodes[internal]
+            go_left = X[rows, self.feature[nodes]] <= self.threshold[nodes]
+            leaves[rows] = np.where(go_left, self.children_left[nodes], self.children_right[nodes])
+        return leaves
+
+    def predict(self, X):
+        return self.value[self.apply(X)]
+
+    def compute_feature_importances(self, normalize=True):
+        importances = np.zeros(self.n_features, dtype=np.float64)
+        internal = np.flatnonzero(self.children_left != TREE_LEAF)
+        left, right = self.children_left[internal], self.children_right[internal]
+        w, imp = self.weighted_n_node_samples, self.impurity
+        decrease = w[internal] * imp[internal] - w[left] * imp[left] - w[right] * imp[right]
+        np.add.at(importances, self.feature[internal], decrease)
+        importances /= w[0]
+        if normalize and importances.sum() > 0.0:
+            importances /= importances.sum()
+        return importances
+
+
+def _impurity(counts, criterion):
+    """ Impurity of class weight rows counts[..., n_classes] and their total weight """
+    total = counts.sum(axis=-1)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        if criterion == 'gini':
+            impurity = 1.0 - np.sum(counts * counts, axis=-1) / (total * total)
+        else:
+            p = counts / total[..., np.newaxis]
+            impurity = -np.sum(np.where(p > 0.0, p * np.log2(np.where(p > 0.0, p, 1.0)), 0.0), axis=-1)
+    return np.where(total > 0.0, impurity, 0.0), total
+
+
+def _lowest_of_runs(run, cost):
+    """ Position of the first lowest cost of every run of equal values in run (ie sorted ids), in run order """
+    starts = np.flatnonzero(np.concatenate(([True], run[1:] != run[:-1])))
+    lowest = np.minimum.reduceat(cost, starts)
+    at_lowest = np.flatnonzero(cost == np.repeat(lowest, np.diff(np.append(starts, len(run)))))
+    return at_lowest[np.concatenate(([True], run[at_lowest][1:] != run[at_lowest][:-1]))]
+
+
+class HistogramTreeClassifier(BaseEstimator, ClassifierMixin):
+    """ A decision tree grown from pre-binned features (see the module docstring).  Built by RandomForestSubsample
+    with fit_binned on codes shared by all trees; fit bins X itself.  Single output, dense X only.
+
+    Parameters mean the same as for sklearn's DecisionTreeClassifier, max_leaf_nodes must be None.  Differences:
+    thresholds are the bin edges, and when no drawn feature has a valid split all remaining features are tried at
+    once instead of one at a time.
+    """
+
+    def __init__(self, criterion="gini", max_depth=None, min_samples_split=2, min_samples_leaf=1,
+                 min_weight_fraction_leaf=0., max_features=None, max_leaf_nodes=None, min_impurity_split=1e-7,
+                 random_state=None, max_bins=255):
+        self.criterion = criterion
+        self.max_depth = max_depth
+        self.min_samples_split = min_samples_split
+        self.min_samples_leaf = min_samples_leaf
+        self.min_weight_fraction_leaf = min_weight_fraction_leaf
+        self.max_features = max_features
+        self.max_leaf_nodes = max_leaf_nodes
+        self.min_impurity_split = min_impurity_split
+        self.random_state = random_state
+        self.max_bins = max_bins
+
+    def fit(self, X, y, sample_weight=None, check_input=True):
+        if issparse(X):
+            raise ValueError("HistogramTreeClassifier does not support sparse X")
+        X = check_array(X, dtype=DTYPE)
+        y = np.asarray(y)
+        if y.ndim == 2 and y.shape[1] == 1:
+            y = y[:, 0]
+        self.classes_, y_codes = np.unique(y, return_inverse=True)
+        binner = HistogramBinner(self.max_bins).fit(X)
+        return self.fit_binned(binner.transform(X), binner.bin_edges_, y_codes, len(self.classes_),
+                               sample_weight, classes=self.classes_)
+
+    def _check_params(self, n_samples, n_features):
+        if self.criterion not in ('gini', 'entropy'):
+            raise ValueError("criterion must be 'gini' or 'entropy' NOT {}".format(self.criterion))
+        if self.max_leaf_nodes is not None:
+            raise ValueError("max_leaf_nodes is not supported by HistogramTreeClassifier")
+        if isinstance(self.min_samples_leaf, (numbers.Integral, np.integer)):
+            min_samples_leaf = self.min_samples_leaf
+        else:
+            min_samples_leaf = int(np.ceil(self.min_samples_leaf * n_samples))
+        if isinstance(self.min_samples_split, (numbers.Integral, np.integer)):
+            min_samples_split = self.min_samples_split
+        else:
+            min_samples_split = int(np.ceil(self.min_samples_split * n_samples))
+        min_samples_split = max(min_samples_split, 2 * min_samples_leaf)
+
+        if self.max_features in ('auto', 'sqrt'):
+            max_features = max(1, int(np.sqrt(n_features)))
+        elif self.max_features == 'log2':
+            max_features = max(1, int(np.log2(n_features)))
+        elif self.max_features is None:
+            max_features = n_features
+        elif isinstance(self.max_features, (numbers.Integral, np.integer)):
+            max_features = self.max_features
+        else:
+            max_features = max(1, int(self.max_features * n_features))
+        if not 0 < max_features <= n_features:
+            raise ValueError("max_features must be in (0, n_features]")
+        max_depth = np.iinfo(np.int32).max if self.max_depth is None else self.max_depth
+        return min_samples_leaf, min_samples_split, max_features, max_depth
+
+    def fit_binned(self, codes, bin_edges, y_codes, n_classes, sample_weight=None, classes=None):
+        """ Grow the tree from uint8 codes (n_samples, n_features) with their bin_edges (see HistogramBinner),
+        class codes 0..n_classes-1 and sample_weight (ie bootstrap counts), rows with zero weight are ignored.
+
+        The tree grows one level at a time (node ids are breadth first) with rows kept sorted by node.  When at least
+        a quarter of the features are drawn per node, every feature of the level's nodes is histogrammed with one
+        bincount per feature, and the larger of two siblings is its parent minus the smaller.  Otherwise only the
+        (node, drawn feature) pairs are, features of any number of bins mixed in chunks of at most _MAX_ENTRIES
+        (row, feature) entries, and only their non empty bins are searched for splits, which is most of the work in
+        the small nodes of a deep tree.  Nodes that can't split (ie fewer rows than min_samples_split) are never
+        histogrammed, except as the smaller sibling of a node that can.
+        """
+        n_samples, n_features = codes.shape
+        self.n_features_ = n_features
+        self.n_classes_ = n_classes
+        self.n_outputs_ = 1
+        self.classes_ = np.arange(n_classes) if classes is None else classes
+        min_samples_leaf, min_samples_split, max_features, max_depth = self._check_params(n_samples, n_features)
+        self.max_features_ = max_features
+        random_state = check_random_state(self.random_state)
+        criterion = self.criterion
+
+        if sample_weight is None:
+            sample_weight = np.ones(n_samples, dtype=np.float64)
+        weights = np.asarray(sample_weight, dtype=np.float64)
+        y_codes = np.asarray(y_codes, dtype=np.intp)
+        rows = np.flatnonzero(weights > 0)
+        min_weight_leaf = self.min_weight_fraction_leaf * weights[rows].sum()
+
+        # single bin features can't split, the others are grouped by their number of bins
+        n_bins = np.asarray([len(edges) + 1 for edges in bin_edges], dtype=np.intp)
+        splittable = np.flatnonzero(n_bins > 1)
+        groups = []
+        for b in np.unique(n_bins[splittable]):
+            columns = np.flatnonzero(n_bins[splittable] == b)
+            groups.append((b, splittable[columns], columns))
+        n_drawn = min(max_features, len(splittable))
+        all_features = 4 * n_drawn >= len(splittable)
+        node_cells = n_classes * n_bins[splittable].sum()
+        edge_table = np.zeros((n_features, max(n_bins.max() - 1, 1)), dtype=np.float64)
+        for f in splittable:
+            edge_table[f, :n_bins[f] - 1] = bin_edges[f]
+
+        def pair_splits(pair_node, pair_feature, hist, counts):
+            """ The best split of every (node, feature) pair from its (n_pairs, n_bins, n_classes) class weights and
+            (n_pairs, n_bins) row counts: (node, cost, feature, bin, left class weights, left row count) """
+            n_pairs, b = counts.shape
+            left = np.cumsum(hist, axis=1)
+            n_left = np.cumsum(counts, axis=1)
+            # only splits right after a non empty bin are distinct
+            pair, split_bin = np.nonzero(counts[:, :-1])
+            node = pair_node[pair]
+            left_value, left_count = left[pair, split_bin], n_left[pair, split_bin]
+            imp_left, w_left = _impurity(left_value, criterion)
+            imp_right, w_right = _impurity(np.maximum(value[node] - left_value, 0.0), criterion)
+            right_count = count[node] - left_count
+            valid = ((left_count >= min_samples_leaf) & (right_count >= min_samples_leaf) & (w_left > 0.0) &
+                     (w_right > 0.0) & (w_left >= min_weight_leaf) & (w_right >= min_weight_leaf))
+            cost = np.full((n_pairs, b - 1), np.inf)
+            cost[pair[valid], split_bin[valid]] = (w_left * imp_left + w_right * imp_right)[valid]
+            pairs = np.arange(n_pairs)
+            split_bin = cost.argmin(axis=1)
+            return (pair_node, cost[pairs, split_bin], pair_feature, split_bin, left[pairs, split_bin],
+                    n_left[pairs, split_bin])
+
+        def level_histograms(scanned, derived):
+            """ Per group, (n_nodes, n_group_features, n_bins, n_classes) class weights and (n_nodes,
+            n_group_features, n_bins) row counts of the scanned nodes, one bincount per feature over the codes of
+            their rows, and of the derived nodes, their parent's minus their sibling's """
+            n_nodes = len(count)
+            row_node = np.repeat(np.arange(n_nodes), count)
+            in_scanned = scanned[row_node]
+            scan_rows, scan_node = rows[in_scanned], row_node[in_scanned]
+            scan_classes, scan_weights = y_codes[scan_rows], weights[scan_rows]
+            hists = []
+            for group, (b, features, columns) in enumerate(groups):
+                hist = np.empty((n_nodes, len(features), b, n_classes), dtype=np.float64)
+                counts = np.empty((n_nodes, len(features), b), dtype=np.intp)
+                node_offsets = scan_node * b
+                for j, f in enumerate(features):
+                    cells = node_offsets + codes[:, f].take(scan_rows)
+                    hist[:, j] = np.bincount(cells * n_classes + scan_classes, weights=scan_weights,
+                                             minlength=n_nodes * b * n_classes).reshape(n_nodes, b, n_classes)
+                    counts[:, j] = np.bincount(cells, minlength=n_nodes * b).reshape(n_nodes, b)
+                if len(derived):
+                    parent_hist, parent_counts = parents[group]
+                    hist[derived] = np.maximum(parent_hist[derived // 2] - hist[derived ^ 1], 0.0)
+                    counts[derived] = parent_counts[derived // 2] - counts[derived ^ 1]
+                hists.append((hist, counts))
+            return hists
+
+        def splits(nodes, drawn):
+            """ pair_splits of the drawn features (a row of drawn over splittable per node in nodes), from the level's
+            histograms if there are, else drawn_splits """
+            if hists is None:
+                return drawn_splits(nodes, drawn)
+            found = []
+            for (b, features, columns), (hist, counts) in zip(groups, hists):
+                pair_column, pair_index = np.nonzero(drawn[:, columns].T)
+                if len(pair_index):
+                    pair_node = nodes[pair_index]
+                    found.append(pair_splits(pair_node, features[pair_column], hist[pair_node, pair_column],
+                                             counts[pair_node, pair_column]))
+            return found
+
+        def cell_splits(pair_node, pair_feature, cell_pair, cell_bin, cell_hist, cell_count):
+            """ pair_splits from only the non empty cells of the pairs, sorted by pair then bin: their pair, bin,
+            (n_cells, n_classes) class weights and row counts.  Every pair has at least one cell """
+            n_pairs = len(pair_node)
+            left = np.cumsum(cell_hist, axis=0)
+            n_left = np.cumsum(cell_count)
+            # the totals of the cells before every pair, the pair's own sums start after them
+            first = np.flatnonzero(np.concatenate(([True], cell_pair[1:] != cell_pair[:-1])))
+            left_before, n_left_before = left[first] - cell_hist[first], n_left[first] - cell_count[first]
+            # a split after every cell but the last of its pair
+            cell = np.flatnonzero(cell_pair[:-1] == cell_pair[1:])
+            pair = cell_pair[cell]
+            node = pair_node[pair]
+            left_value, left_count = left[cell] - left_before[pair], n_left[cell] - n_left_before[pair]
+            imp_left, w_left = _impurity(left_value, criterion)
+            imp_right, w_right = _impurity(np.maximum(value[node] - left_value, 0.0), criterion)
+            right_count = count[node] - left_count
+            valid = np.flatnonzero((left_count >= min_samples_leaf) & (right_count >= min_samples_leaf) &
+                                   (w_left > 0.0) & (w_right > 0.0) & (w_left >= min_weight_leaf) &
+                                   (w_right >= min_weight_leaf))
+            best_cost = np.full(n_pairs, np.inf)
+            best_bin = np.zeros(n_pairs, dtype=np.intp)
+            best_left = np.zeros((n_pairs, n_classes))
+            best_n_left = np.zeros(n_pairs, dtype=np.intp)
+            if len(valid):
+                cost = (w_left[valid] * imp_left[valid] + w_right[valid] * imp_right[valid])
+                # the lowest bin of a pair on ties, like pair_splits
+                lowest = _lowest_of_runs(pair[valid], cost)
+                best = valid[lowest]
+                best_pair = pair[best]
+                best_cost[best_pair] = cost[lowest]
+                best_bin[best_pair] = cell_bin[cell[best]]
+                best_left[best_pair] = left_value[best]
+                best_n_left[best_pair] = left_count[best]
+            return pair_node, best_cost, pair_feature, best_bin, best_left, best_n_left
+
+        def drawn_splits(nodes, drawn):
+            """ pair_splits of the drawn features of nodes, histogrammed from the codes of their rows in chunks of
+            whole pairs of any features, with up to _MAX_ENTRIES (row, feature) entries and as many bins.  Only the
+            non empty bins are searched (see cell_splits), most bins of the small nodes of a deep tree are empty """
+            node_start = np.concatenate(([0], np.cumsum(count)))
+            row_classes, row_weights = y_codes[rows], weights[rows]
+            # pairs sorted by feature, so the entries of a feature are contiguous and read from its own column
+            pair_column, pair_index = np.nonzero(drawn.T)
+            pair_node, pair_feature = nodes[pair_index], splittable[pair_column]
+            pair_size, pair_bins = count[pair_node], n_bins[pair_feature]
+            size_ends, bin_ends = np.cumsum(pair_size), np.cumsum(pair_bins)
+            found = []
+            start = 0
+            while start < len(pair_node):
+                stop = min(np.searchsorted(size_ends, size_ends[start] - pair_size[start] + _MAX_ENTRIES, side='right'),
+                           np.searchsorted(bin_ends, bin_ends[start] - pair_bins[start] + _MAX_ENTRIES, side='right'))
+                stop = max(stop, start + 1)
+                chunk_node, chunk_feature = pair_node[start:stop], pair_feature[start:stop]
+                sizes, bins = pair_size[start:stop], pair_bins[start:stop]
+                n_pairs = stop - start
+                entry_pos = (np.repeat(node_start[chunk_node] - (np.cumsum(sizes) - sizes), sizes) +
+                             np.arange(sizes.sum()))
+                entry_rows = rows[entry_pos]
+                entry_codes = np.empty(len(entry_rows), dtype=np.uint8)
+                feature_starts = np.flatnonzero(np.diff(np.concatenate(([-1], chunk_feature))))
+                entry_bounds = np.concatenate(([0], np.cumsum(sizes)))[np.append(feature_starts, n_pairs)]
+                for i, f in enumerate(chunk_feature[feature_starts]):
+                    segment = slice(entry_bounds[i], entry_bounds[i + 1])
+                    entry_codes[segment] = codes[:, f].take(entry_rows[segment])
+                # the bins of the i-th pair are cells bin_start[i] to bin_start[i] + bins[i] - 1
+                bin_start = np.cumsum(bins) - bins
+                n_cells = bin_start[-1] + bins[-1]
+                cells = np.repeat(bin_start, sizes) + entry_codes
+                counts = np.bincount(cells, minlength=n_cells)
+                hist = np.bincount(cells * n_classes + row_classes[entry_pos], weights=row_weights[entry_pos],
+                                   minlength=n_cells * n_classes).reshape(n_cells, n_classes)
+                cell = np.flatnonzero(counts)
+                cell_pair = np.repeat(np.arange(n_pairs), bins)[cell]
+                found.append(cell_splits(chunk_node, chunk_feature, cell_pair, cell - bin_start[cell_pair], hist[cell],
+                                         counts[cell]))
+                start = stop
+            return found
+
+        def lowest(found, nodes):
+            """ The lowest cost split of every node in nodes among found, cost is inf if there is none """
+            best = (np.full(len(count), np.inf), np.zeros(len(count), dtype=np.intp),
+                    np.zeros(len(count), dtype=np.intp), np.zeros((len(count), n_classes)),
+                    np.zeros(len(count), dtype=np.intp))
+            if found:
+                pair_node, pair_cost, pair_feature, pair_bin, pair_left, pair_n_left = [
+                    np.concatenate(arrays) for arrays in zip(*found)]
+                order = np.argsort(pair_node, kind='mergesort')
+                first = order[_lowest_of_runs(pair_node[order], pair_cost[order])]
+                for out, pair in zip(best, (pair_cost, pair_feature, pair_bin, pair_left, pair_n_left)):
+                    out[pair_node[first]] = pair[first]
+            return tuple(out[nodes] for out in best)
+
+        levels = []
+        value = np.bincount(y_codes[rows], weights=weights[rows], minlength=n_classes)[np.newaxis].astype(np.float64)
+        count = np.asarray([len(rows)], dtype=np.intp)
+        # histograms of the split nodes of the previous level, the i-th is the parent of nodes 2i and 2i+1
+        parents = None
+        first_id, depth = 0, 0
+        while True:
+            n_nodes = len(count)
+            impurity, weight = _impurity(value, criterion)
+            is_open = ~((depth >= max_depth) | (count < min_samples_split) | (count < 2 * min_samples_leaf) |
+                        (weight < 2 * min_weight_leaf) | (impurity <= self.min_impurity_split))
+            open_nodes = np.flatnonzero(is_open) if len(splittable) else np.empty(0, dtype=np.intp)
+            n_open = len(open_nodes)
+
+            drawn = np.ones((n_open, len(splittable)), dtype=bool)
+            if n_open and n_drawn < len(splittable):
+                drawn[:] = False
+                picked = np.argpartition(random_state.rand(n_open, len(splittable)), n_drawn - 1, axis=1)
+                drawn[np.arange(n_open)[:, np.newaxis], picked[:, :n_drawn]] = True
+            hists = None
+            if n_open and all_features and n_nodes * node_cells <= _MAX_ENTRIES:
+                if parents is not None:
+                    # scan the smaller of two siblings, the larger one is derived from their parent
+                    sibling = np.arange(n_nodes) ^ 1
+                    smaller = (count < count[sibling]) | ((count == count[sibling]) & (np.arange(n_nodes) % 2 == 0))
+                    hists = level_histograms(smaller & (is_open | is_open[sibling]),
+                                             np.flatnonzero(~smaller & is_open))
+                else:
+                    hists = level_histograms(is_open, np.empty(0, dtype=np.intp))
+            best = lowest(splits(open_nodes, drawn), open_nodes)
+            # a node without a valid split among its drawn features takes the best of the others
+            retry = np.flatnonzero(np.isinf(best[0]))
+            if len(retry) and n_drawn < len(splittable):
+                for out, retried in zip(best, lowest(splits(open_nodes[retry], ~drawn[retry]), open_nodes[retry])):
+                    out[retry] = retried
+            best_cost, best_feature, best_bin, best_left, best_n_left = best
+            is_split = np.isfinite(best_cost)
+            split_nodes = open_nodes[is_split]
+            split_feature, split_bin = best_feature[is_split], best_bin[is_split]
+            n_split = len(split_nodes)
+
+            feature = np.full(n_nodes, TREE_UNDEFINED, dtype=np.intp)
+            threshold = np.full(n_nodes, TREE_UNDEFINED, dtype=np.float64)
+            children_left = np.full(n_nodes, TREE_LEAF, dtype=np.intp)
+            children_right = np.full(n_nodes, TREE_LEAF, dtype=np.intp)
+            feature[split_nodes] = split_feature
+            threshold[split_nodes] = edge_table[split_feature, split_bin]
+            children_left[split_nodes] = first_id + n_nodes + 2 * np.arange(n_split)
+            children_right[split_nodes] = children_left[split_nodes] + 1
+            levels.append((children_left, children_right, feature, threshold, value, impurity, count, weight))
+            if n_split == 0:
+                break
+
+            # rows of the i-th split node move to its children 2i (left) and 2i+1 (right), still sorted by node
+            split_index = np.full(n_nodes, -1, dtype=np.intp)
+            split_index[split_nodes] = np.arange(n_split)
+            row_split = np.repeat(split_index, count)
+            in_split = row_split >= 0
+            rows, row_split = rows[in_split], row_split[in_split]
+            child = 2 * row_split + (codes[rows, split_feature[row_split]] > split_bin[row_split])
+            rows = rows[np.argsort(child, kind='mergesort')]
+
+            parents = None
+            if hists is not None and 2 * n_split * node_cells <= _MAX_ENTRIES:
+                parents = [(hist[split_nodes], counts[split_nodes]) for hist, counts in hists]
+            left_value, left_count = best_left[is_split], best_n_left[is_split]
+            child_value = np.empty((2 * n_split, n_classes), dtype=np.float64)
+            child_value[0::2] = left_value
+            child_value[1::2] = np.maximum(value[split_nodes] - left_value, 0.0)
+            child_count = np.empty(2 * n_split, dtype=np.intp)
+            child_count[0::2] = left_count
+            child_count[1::2] = count[split_nodes] - left_count
+            value, count = child_value, child_count
+            first_id += n_nodes
+            depth += 1
+
+        children_left, children_right, feature, threshold, value, impurity, count, weight = [
+            np.concatenate(arrays) for arrays in zip(*levels)]
+        self.tree_ = _HistTree(n_features, n_classes, children_left, children_right, feature, threshold,
+                               value[:, np.newaxis, :], impurity, count, weight, depth)
+        return self
+
+    def _validate_X_predict(self, X, check_input):
+        if check_input:
+            X = check_array(X, dtype=DTYPE, accept_sparse='csr')
+        if issparse(X):
+            X = X.toarray()
+        if X.shape[1] != self.n_features_:
+            raise ValueError("Number of features of the model must match the input. Model n_features is {} and "
+                             "input n_features is {}".format(self.n_features_, X.shape[1]))
+        return X
+
+    def apply(self, X, check_input=True):
+        check_is_fitted(self, 'tree_')
+        return self.tree_.apply(self._validate_X_predict(X, check_input))
+
+    def predict_proba(self, X, check_input=True):
+        check_is_fitted(self, 'tree_')
+        proba = self.tree_.predict(self._validate_X_predict(X, check_input))[:, 0, :]
+        normalizer = proba.sum(axis=1)[:, np.newaxis]
+        normalizer[normalizer == 0.0] = 1.0
+        return proba / normalizer
+
+    def predict(self, X, check_input=True):
+        return self.classes_.take(np.argmax(self.predict_proba(X, check_input), axis=1), axis=0)
+
+    @property
+    def feature_importances_(self):
+        check_is_fitted(self, 'tree_')
+        return self.tree_.compute_feature_importances()
@@ -24,6 +24,7 @@ from sklearn.utils.metaestimators import _safe_split
 from sklearn.utils.validation import _num_samples, indexable
 
 from .frankenscorer import FrankenScorer
+from .shareddata import SharedDataset
 
 def _fit_and_score_with_extra_data(estimator, X, y, scorer, train, test, verbose,
                    parameters, fit_params, return_train_score=False,
@@ -37,8 +38,8 @@ def _fit_and_score_with_extra_data(estimator, X, y, scorer, train, test, verbose
     estimator : estimator object implementing 'fit'
         The object to use to fit the data.
 
-    X : array-like of shape at least 2D
-        The data to fit.
+    X : array-like of shape at least 2D or SharedDataset
+        The data to fit.  If a SharedDataset, X and y are loaded memory-mapped from it and y is ignored.
 
     y : array-like, optional, default: None
         The target variable to try to predict in the case of
@@ -115,6 +116,9 @@ def _fit_and_score_with_extra_data(estimator, X, y, scorer, train, test, verbose
                           for k, v in parameters.items()))
         print("[CV] %s %s" % (msg, (64 - len(msg)) * '.'))
 
+    if isinstance(X, SharedDataset):
+        X, y = X.load()
+
     # Adjust length of sample weights
     fit_params = fit_params if fit_params is not None else {}
     fit_params = dict([(k, _index_param_value(X, v, train))
@@ -308,6 +312,12 @@ class JRandomSearchCV(BaseSearchCV):
         If ``'False'``, the ``cv_results_`` attribute will not include training
         scores.
 
+    share_data : boolean, default=False
+        If True, X and y are dumped once to memory-mapped files (see
+        SharedDataset) and only a handle to them and the fold indices are sent
+        to each parallel fit, instead of pickling X and y for every task.
+        X must be numeric.
+
     Attributes
     ----------
     cv_results_ : dict of numpy (masked) ndarrays
@@ -407,10 +417,11 @@ class JRandomSearchCV(BaseSearchCV):
     def __init__(self, estimator, param_distributions, n_iter=10, scoring=None,
                  fit_params=None, n_jobs=1, iid=True, refit=True, cv=None,
                  verbose=0, pre_dispatch='2*n_jobs', random_state=None,
-                 error_score='raise', return_train_score=True):
+                 error_score='raise', return_train_score=True, share_data=False):
         self.param_distributions = param_distributions
         self.n_iter = n_iter
         self.random_state = random_state
+        self.share_data = share_data
         super(JRandomSearchCV, self).__init__(
              estimator=estimator, scoring=scoring, fit_params=fit_params,
              n_jobs=n_jobs, iid=iid, refit=refit, cv=cv, verbose=verbose,
@@ -459,18 +470,24 @@ class JRandomSearchCV(BaseSearchCV):
             pre_dispatch = self.pre_dispatch
 
             cv_iter = list(cv.split(X, y, groups))
-            out = Parallel(
-                n_jobs=self.n_jobs, verbose=self.verbose,
-                pre_dispatch=pre_dispatch
-            )(delayed(_fit_and_score_with_extra_data)(clone(base_estimator), X, y, self.scorer_,
-                                      train, test, self.verbose, parameters,
-                                      fit_params=self.fit_params,
-                                      return_train_score=self.return_train_score,
-                                      return_n_test_samples=True,
-                                      return_times=True, return_parameters=True,
-                                      error_score=self.error_score)
-              for parameters in parameter_iterable
-              for train, test in cv_iter)
+            shared = SharedDataset(X, y) if self.share_data else None
+            try:
+                X_task, y_task = (shared, None) if shared is not None else (X, y)
+                out = Parallel(
+                    n_jobs=self.n_jobs, verbose=self.verbose,
+                    pre_dispatch=pre_dispatch
+                )(delayed(_fit_and_score_with_extra_data)(clone(base_estimator), X_task, y_task, self.scorer_,
+                                          train, test, self.verbose, parameters,
+                                          fit_params=self.fit_params,
+                                          return_train_score=self.return_train_score,
+                                          return_n_test_samples=True,
+                                          return_times=True, return_parameters=True,
+                                          error_score=self.error_score)
+                  for parameters in parameter_iterable
+                  for train, test in cv_iter)
+            finally:
+                if shared is not None:
+                    shared.close()
 
             # if one choose to see train score, "out" will contain train score info
             if self.return_train_score:
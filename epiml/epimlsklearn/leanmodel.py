@@ -0,0 +1,69 @@
+# -*- coding: utf-8 -*-
+"""
+Helpers to save models without the training data PNUWrapper and RepeatedRandomSubSampler keep after fit
+"""
+
+from contextlib import contextmanager
+
+from .pnuwrapper import PNUWrapper
+from .repeatedsampling import RepeatedRandomSubSampler
+
+# fitted attributes of PNUWrapper and RepeatedRandomSubSampler that only hold (copies of) the training data, they
+# don't need them to predict.  Other estimators may use the same names for data they predict with (ie X_ of
+# LabelSpreading), so they are left alone
+TRAINING_DATA_ATTRS = ('X_', 'y_', 'samples_indices_')
+TRAINING_DATA_HOLDERS = (PNUWrapper, RepeatedRandomSubSampler)
+
+
+def _walk_estimators(obj, seen=None):
+    """ Yield obj and every estimator nested in it: pipeline steps, base_estimator, estimators_, best_estimator_, the
+    estimators_ of a NestedCV, estimators kept in dicts, etc. """
+    if seen is None:
+        seen = set()
+    if id(obj) in seen:
+        return
+    seen.add(id(obj))
+    if isinstance(obj, (list, tuple)):
+        for item in obj:
+            yield from _walk_estimators(item, seen)
+        return
+    if isinstance(obj, dict):
+        for item in obj.values():
+            yield from _walk_estimators(item, seen)
+        return
+    if not (hasattr(obj, 'get_params') or hasattr(obj, 'estimators_')):
+        return
+    yield obj
+    for value in vars(obj).values():
+        yield from _walk_estimators(value, seen)
+
+def _training_data_holders(obj):
+    """ The PNUWrapper and RepeatedRandomSubSampler instances among obj and everything nested in it """
+    return (estimator for estimator in _walk_estimators(obj) if isinstance(estimator, TRAINING_DATA_HOLDERS))
+
+@contextmanager
+def without_training_data(obj):
+    """ Temporarily remove the training data held by obj and everything nested in it, restoring it on exit:
+
+        with without_training_data(clf):
+            joblib.dump(clf, filename)
+    """
+    removed = []
+    for estimator in _training_data_holders(obj):
+        for attr in TRAINING_DATA_ATTRS:
+            if attr in vars(estimator):
+                removed.append((estimator, attr, vars(estimator).pop(attr)))
+    try:
+        yield obj
+    finally:
+        for estimator, attr, value in removed:
+            setattr(estimator, attr, value)
+
+def strip_training_data(obj):
+    """ Permanently remove the training data held by obj and everything nested in it (ie a NestedCV or
+    JRandomSearchCV holding many fitted models) to free memory.  Prediction and feature_importances_ still work.
+    Returns obj """
+    for estimator in _training_data_holders(obj):
+        for attr in TRAINING_DATA_ATTRS:
+            vars(estimator).pop(attr, None)
+    return obj
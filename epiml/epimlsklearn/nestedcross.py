@@ -17,6 +17,8 @@ from sklearn.metrics.scorer import check_scoring
 from sklearn.externals.joblib import Parallel, delayed
 
 from .jsearchcv import _fit_and_score_with_extra_data, extract_score_grid
+from .shareddata import SharedDataset
+from .parallelbudget import allocate_n_jobs
 
 def check_cv2(cv=3, y=None, classifier=False, random_state=None):
     """Input checker utility for building a cross-validator
@@ -99,32 +101,53 @@ class NestedCV():
         self.random_state = random_state
         self.use_same_random_state = use_same_random_state
 
-    def score(self, X, y=None, groups=None, n_jobs=1, verbose=0, pre_dispatch='2*n_jobs'):
+    def score(self, X, y=None, groups=None, n_jobs=1, verbose=0, pre_dispatch='2*n_jobs', share_data=False,
+              n_jobs_budget=None, backends=None):
         """ Will score the estimator and score according to self.cv
+
+        share_data : Boolean, optional, default = False
+            if true, X and y are dumped once to memory-mapped files (see SharedDataset) and each outer fold is only
+            sent a handle to them and its fold indices instead of a pickled copy of X and y.  X must be numeric.
+        n_jobs_budget : int or None, optional, default = None
+            if not None, the total number of cores (joblib meaning, -1 is all of them) split between the outer folds
+            and the levels nested in estimator (see parallelbudget.allocate_n_jobs), n_jobs is then ignored.  The
+            n_jobs of a clone of self.estimator are changed, not those of self.estimator
+        backends : dict or None, optional, default = None
+            per estimator class joblib backends, used with n_jobs_budget (see parallelbudget.allocate_n_jobs)
         """
         X, y, groups = indexable(X, y, groups)
         if not isinstance(self.random_state, (numbers.Integral, np.integer)) and self.use_same_random_state:
             raise ValueError("If use_same_randome_state, the random state passed in must be an Integer")
+        template = clone(self.estimator)
         def clone_estimator():
             """Clone the estimator and put in the correct random state for the nested cross validation
             """
-            estimator = clone(self.estimator)
+            estimator = clone(template)
             if self.use_same_random_state and ('random_state' in estimator.get_params().keys()):
                 estimator.set_params(random_state=self.random_state)
             return estimator
 
         cv = check_cv2(self.cv, y, classifier=is_classifier(self.estimator), random_state=self.random_state)
         self.cv_iter_ = list(cv.split(X, y, groups))
+        if n_jobs_budget is not None:
+            n_jobs = allocate_n_jobs(template, n_jobs=n_jobs_budget, outer_tasks=len(self.cv_iter_),
+                                     backends=backends, verbose=verbose)
         scorer = check_scoring(self.estimator, scoring=self.scoring)
         # We clone the estimator to make sure that all the folds are
         # independent, and that it is pickle-able.
         parallel = Parallel(n_jobs=n_jobs, verbose=verbose,
                             pre_dispatch=pre_dispatch)
-        scores = parallel(delayed(_fit_and_score_with_extra_data)(clone_estimator(), X, y, scorer,
-                                                  train, test, verbose, None,
-                                                  self.fit_params, return_train_score=True,
-                                                  return_times=True, return_estimator=True)
-                          for train, test in self.cv_iter_)
+        shared = SharedDataset(X, y) if share_data else None
+        try:
+            X_task, y_task = (shared, None) if shared is not None else (X, y)
+            scores = parallel(delayed(_fit_and_score_with_extra_data)(clone_estimator(), X_task, y_task, scorer,
+                                                      train, test, verbose, None,
+                                                      self.fit_params, return_train_score=True,
+                                                      return_times=True, return_estimator=True)
+                              for train, test in self.cv_iter_)
+        finally:
+            if shared is not None:
+                shared.close()
 
         (self.train_score_datas_, self.train_scores_, self.test_score_datas_, self.test_scores_,
                  self.fit_times_, self.score_times_, self.estimators_) = zip(*scores)
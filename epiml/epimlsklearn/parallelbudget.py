@@ -0,0 +1,99 @@
+# -*- coding: utf-8 -*-
+"""
+Split one core budget across the nested levels of parallelism of a model (outer cross validation, search candidates,
+repeated subsamples, forest trees) instead of letting every level use n_jobs=-1 and oversubscribe the machine
+"""
+
+import numbers
+
+from sklearn.externals.joblib import cpu_count
+from sklearn.model_selection._split import check_cv
+
+
+def _effective_n_jobs(n_jobs):
+    """ joblib's meaning of n_jobs: -1 is every core, -2 all but one, etc """
+    if n_jobs < 0:
+        return max(cpu_count() + 1 + n_jobs, 1)
+    return max(n_jobs, 1)
+
+def _n_tasks(estimator):
+    """ How many independent tasks a level can run at once, None if unknown (so it may use the whole budget) """
+    if hasattr(estimator, 'n_iter') and hasattr(estimator, 'cv'):
+        # a random search fits n_iter candidates on every split
+        cv = estimator.cv
+        n_splits = cv if isinstance(cv, numbers.Integral) else check_cv(cv).get_n_splits()
+        return estimator.n_iter * n_splits
+    if hasattr(estimator, 'estimators_'):
+        return len(estimator.estimators_)
+    if hasattr(estimator, 'n_estimators'):
+        return estimator.n_estimators
+    return None
+
+def _nested_levels(estimator):
+    """ Yield estimator and the estimators it will clone and fit, outermost first: the estimator of a search,
+    the base_estimator of a wrapper or the steps of a pipeline """
+    yield estimator
+    if hasattr(estimator, 'steps'):
+        for _, step in estimator.steps:
+            yield from _nested_levels(step)
+        return
+    for attr in ('estimator', 'base_estimator'):
+        inner = getattr(estimator, attr, None)
+        if inner is not None and hasattr(inner, 'get_params'):
+            yield from _nested_levels(inner)
+            return
+
+def allocate_n_jobs(estimator, n_jobs=-1, outer_tasks=None, backends=None, verbose=0):
+    """ Allocate a budget of n_jobs cores top-down over the nested parallel levels of estimator and set the n_jobs of
+    every level (in place, so clones made during fit inherit it).  Each level, outermost first, gets as many workers
+    as it has tasks, up to what is left of the budget, and the levels inside it share what remains per worker.  A
+    level deeper than the budget allows runs with n_jobs=1.
+
+        outer_n_jobs = allocate_n_jobs(search, n_jobs=-1, outer_tasks=3)
+        nested.score(X, y, n_jobs=outer_n_jobs)
+
+    Parameters
+    ----------
+    n_jobs : int, optional, default=-1
+        The total core budget, in joblib's meaning (-1 is every core)
+    outer_tasks : int or None, optional, default=None
+        The number of tasks of a caller's own outer loop, ie the outer folds of a NestedCV.  None if there is no
+        outer loop
+    backends : dict or None, optional, default=None
+        Joblib backend ('threading' or 'multiprocessing') of a level, keyed by the estimator's class name, ie
+        {'RepeatedRandomSubSampler': 'threading'}.  Only set on estimators with a backend parameter, see their
+        docs for other values (ie RepeatedRandomSubSampler's 'shared_memory' process pool).  A process pool can't
+        be started inside multiprocessing workers, so 'shared_memory' only takes effect when every outer level
+        gets n_jobs=1 (or uses threads), otherwise RepeatedRandomSubSampler warns and falls back to joblib
+    verbose : int, optional, default=0
+        Print the allocation if > 0
+
+    Returns
+    -------
+    The n_jobs for the outer loop (1 if outer_tasks is None)
+    """
+    budget = _effective_n_jobs(n_jobs)
+    backends = backends or {}
+
+    def take(tasks):
+        nonlocal budget
+        level_jobs = budget if tasks is None else max(min(budget, tasks), 1)
+        budget = max(budget // level_jobs, 1)
+        return level_jobs
+
+    outer_n_jobs = 1 if outer_tasks is None else take(outer_tasks)
+    if verbose > 0:
+        print("outer loop: n_jobs={}".format(outer_n_jobs))
+    for level in _nested_levels(estimator):
+        params = level.get_params(deep=False)
+        if 'n_jobs' not in params:
+            continue
+        level_jobs = take(_n_tasks(level))
+        new_params = {'n_jobs': level_jobs}
+        name = type(level).__name__
+        if name in backends and 'backend' in params:
+            new_params['backend'] = backends[name]
+        level.set_params(**new_params)
+        if verbose > 0:
+            print("{}: {}".format(name, ", ".join("{}={}".format(k, v) for k, v in sorted(new_params.items()))))
+    return outer_n_jobs
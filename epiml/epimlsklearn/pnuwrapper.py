@@ -9,6 +9,7 @@ from sklearn.utils.validation import check_X_y, check_array, check_is_fitted
 from sklearn.utils import check_random_state
 
 from epiml.semisuperhelper import SemiSupervisedHelper
+from epiml.epimlsklearn.epimlmetrics import pu_mix_assumed_f1beta10
 
 
 class PNUWrapper(BaseEstimator, ClassifierMixin, MetaEstimatorMixin):
@@ -31,6 +32,9 @@ class PNUWrapper(BaseEstimator, ClassifierMixin, MetaEstimatorMixin):
             If it is left None, then calibration on the unseen data will not be used
         All unlabeled data is assumed to be of class "0"
         if pu_learning == True, then throw away negatives in the set and train only on P and U class (default False)
+        If base_estimator computes out-of-bag probabilities (ie RepeatedRandomSubSampler(oob_score=True)), fit sets
+            oob_decision_function_ (one row per training row of base_estimator: the labeled rows, then the unlabeled
+            rows used) and oob_score_, its pu_mix_assumed_f1beta10 against the true labels, unlabeled kept as -1
         """
         self.base_estimator = base_estimator
         self.num_unlabeled = num_unlabeled
@@ -64,6 +68,9 @@ class PNUWrapper(BaseEstimator, ClassifierMixin, MetaEstimatorMixin):
 
         X_temp, y_temp, X_unlabeled_unused = ssh.pn_assume(X, unlabeled_pct=self.num_unlabeled)
         self.base_estimator.fit(X_temp, y_temp)
+        # pn_assume stacks the labeled rows first, then the unlabeled rows it assumed negative
+        n_labeled = np.sum(ssh.pn_mask)
+        y_true_temp = np.concatenate((ssh.y[ssh.pn_mask], np.full(len(y_temp) - n_labeled, -1, dtype=y_temp.dtype)))
 
         if hasattr(self.base_estimator, 'decision_function'):
             self.threshold_fn_ = self.base_estimator.decision_function
@@ -71,7 +78,8 @@ class PNUWrapper(BaseEstimator, ClassifierMixin, MetaEstimatorMixin):
             self.threshold_fn_ = self.base_estimator.predict_proba
         else:
             self.threshold_fn_ = None
-        if self.threshold_fn_ is not None and self.threshold_set_pct is not None and len(X_unlabeled_unused) > 0:
+        if self.threshold_fn_ is not None and self.threshold_set_pct is not None and \
+                X_unlabeled_unused.shape[0] > 0:
             unlabeled_threshold = self.threshold_fn_(X_unlabeled_unused)
             if len(unlabeled_threshold.shape) > 1:
                 unlabeled_threshold = unlabeled_threshold[:, -1]
@@ -82,9 +90,56 @@ class PNUWrapper(BaseEstimator, ClassifierMixin, MetaEstimatorMixin):
         else:
             self.threshold_ = None
 
+        if hasattr(self.base_estimator, 'oob_decision_function_'):
+            self._set_oob_score(y_true_temp)
+
         # Return the classifier
         return self
 
+    def _set_oob_score(self, y_true):
+        """ Score base_estimator's out-of-bag probabilities with the true (-1, 0, 1) labels of its training rows,
+        using threshold_ when it was calibrated, otherwise base_estimator's own decision rule """
+        self.oob_decision_function_ = self.base_estimator.oob_decision_function_
+        has_oob = ~np.isnan(self.oob_decision_function_[:, -1])
+        proba = self.oob_decision_function_[has_oob]
+        if self.threshold_ is not None:
+            y_pred = np.asarray(proba[:, -1] >= self.threshold_, dtype=np.int)
+        elif hasattr(self.base_estimator, '_decide'):
+            y_pred = self.base_estimator._decide(proba)
+        else:
+            y_pred = np.argmax(proba, axis=1)
+        self.oob_score_ = pu_mix_assumed_f1beta10(y_true[has_oob], y_pred)
+
+    def update(self, X, y, max_age=None):
+        """
+        Incrementally retrain base_estimator (which must have an update method, ie RepeatedRandomSubSampler) with new
+        data.  X, y are prepared the same way as in fit (unlabeled assumed negative, negatives dropped if
+        pu_learning) and passed to base_estimator.update.  For a RepeatedRandomSubSampler, X, y should hold the new
+        unlabeled / negative rows plus every current positive.  threshold_ is not recalibrated.
+        """
+        check_is_fitted(self, ['classes_'])
+        if not hasattr(self.base_estimator, 'update'):
+            raise AttributeError("update doesn't exist for: {}".format(self.base_estimator))
+        random_state = check_random_state(self.random_state)
+        X, y = check_X_y(X, y, accept_sparse=['csr', 'csc'])
+        if np.setdiff1d(y, np.asarray([-1, 0, 1])):
+            raise ValueError("y must contain only -1 (unlabeled), 0 (negative), and 1 (positive) labels.")
+        if self.n_features_ != X.shape[1]:
+            raise ValueError("Number of features of the model must "
+                             "match the input. Model n_features is {0} and "
+                             "input n_features is {1}."
+                             "".format(self.n_features_, X.shape[1]))
+
+        ssh = SemiSupervisedHelper(y, random_state=random_state)
+        if self.pu_learning:
+            X, y = ssh.pu(X)
+            ssh = SemiSupervisedHelper(y, random_state=random_state)
+        X_temp, y_temp, _ = ssh.pn_assume(X, unlabeled_pct=self.num_unlabeled)
+        self.base_estimator.update(X_temp, y_temp, max_age=max_age)
+        for attr in ('oob_decision_function_', 'oob_score_'):
+            vars(self).pop(attr, None)
+        return self
+
     def predict(self, X):
 
         # Check is fit had been called
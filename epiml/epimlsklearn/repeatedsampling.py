@@ -7,16 +7,27 @@ Created on Sun Jan 29 00:09:12 2017
 
 import numpy as np
 import math
+import multiprocessing
+import numbers
+import warnings
+from concurrent.futures import ProcessPoolExecutor
+from scipy.sparse import issparse
 
 from sklearn.base import BaseEstimator, ClassifierMixin, MetaEstimatorMixin, clone
-from sklearn.utils.validation import check_X_y, check_array, check_is_fitted
-from sklearn.utils import check_random_state
+from sklearn.utils.validation import check_X_y, check_array, check_is_fitted, has_fit_parameter
+from sklearn.utils import check_random_state, _get_n_jobs
 from sklearn.externals.joblib import Parallel, delayed
 from sklearn.utils.fixes import parallel_helper
 from sklearn.utils.random import choice
 
+from .epimlmetrics import pu_mix_assumed_f1beta10
+from .shareddata import SharedDataset, SharedMemoryDataset
+from .forestengine import CompiledForest
+
 __all__ = ["RepeatedRandomSubSampler"]
 
+MAX_INT = np.iinfo(np.int32).max
+
 def _generate_class_indices(y):
     """ Generate all the indices of each class in ascending order"""
     return [np.where(y==c)[0] for c in np.unique(y)]
@@ -52,6 +63,69 @@ def _parallel_fit_base_estimator(estimator, X, y):
     estimator.fit(X, y)
     return estimator
 
+def _parallel_fit_shared(estimator, shared, indices):
+    """Fit on the rows in indices of a SharedDataset, only the handle and indices are sent to the worker"""
+    X, y = shared.load()
+    estimator.fit(X[indices, :], y[indices])
+    return estimator
+
+def _absolute_min_samples(estimator, n_samples):
+    """Replace fractional min_samples_split / min_samples_leaf (at any nesting level) of estimator with the row counts
+    they give for n_samples rows.  sklearn converts fractions with X.shape[0], which under a sample_weight mask is
+    the full X and not the sampled rows"""
+    params = {}
+    for name, value in estimator.get_params(deep=True).items():
+        if not (name.endswith('min_samples_split') or name.endswith('min_samples_leaf')):
+            continue
+        if isinstance(value, (numbers.Integral, np.integer)) or not isinstance(value, numbers.Real):
+            continue
+        # the same rounding and lower bounds as sklearn's trees
+        minimum = 2 if name.endswith('min_samples_split') else 1
+        params[name] = max(minimum, int(math.ceil(value * n_samples)))
+    if params:
+        estimator.set_params(**params)
+    return estimator
+
+def _parallel_fit_weighted(estimator, X, y, indices):
+    """Fit on all of X with a sample_weight of 1 for rows in indices and 0 otherwise, so X[indices] is never copied"""
+    sample_weight = np.bincount(indices, minlength=X.shape[0]).astype(np.float64)
+    _absolute_min_samples(estimator, len(indices))
+    estimator.fit(X, y, sample_weight=sample_weight)
+    return estimator
+
+def _parallel_fit_shared_weighted(estimator, shared, indices):
+    X, y = shared.load()
+    return _parallel_fit_weighted(estimator, X, y, indices)
+
+def _fit_shared_memory(estimator, shared, indices, weighted):
+    """Process pool worker: fit on the rows in indices of a SharedMemoryDataset"""
+    X, y = shared.load()
+    try:
+        if weighted:
+            # the fitted estimator may keep views of the shared X, so the block stays mapped (see detach)
+            return _parallel_fit_weighted(estimator, X, y, indices)
+        return _parallel_fit_base_estimator(estimator, X[indices, :], y[indices])
+    finally:
+        del X, y
+        shared.detach()
+
+def _parallel_oob_proba(estimator, X, indices):
+    """predict_proba of estimator on the rows of X it was not trained on, returns those rows and the probabilities"""
+    mask = np.ones(X.shape[0], dtype=np.bool)
+    mask[indices] = False
+    oob = np.flatnonzero(mask)
+    return oob, estimator.predict_proba(X[oob])
+
+def _hold_out_minority(random_state, y, majority_class, samples_indices):
+    """Split the minority rows into one fold per sample and remove fold i from sample i, so every minority row is
+    out-of-bag for exactly one sub-estimator"""
+    if len(samples_indices) < 2:
+        raise ValueError("oob_score needs at least 2 sub-estimators, sample_imbalance gives only {}".format(
+                         len(samples_indices)))
+    min_indices = np.flatnonzero(y != majority_class)
+    folds = random_state.permutation(len(min_indices)) % len(samples_indices)
+    return [indices[~np.in1d(indices, min_indices[folds == i])] for i, indices in enumerate(samples_indices)]
+
 def check_voting(estimator):
     if estimator.voting not in ('soft', 'hard', 'thresh'):
         raise ValueError("{}.voting must be in ('soft', 'hard', or 'thresh') NOT {}".format(estimator, estimator.voting))
@@ -66,7 +140,8 @@ class RepeatedRandomSubSampler(BaseEstimator, ClassifierMixin, MetaEstimatorMixi
     """
 
     def __init__(self, base_estimator=None, sample_imbalance=1.0, voting='hard', binary_thresh=0.5,
-                 random_state=None, n_jobs=1, verbose=0, pre_dispatch='2*n_jobs'):
+                 random_state=None, n_jobs=1, verbose=0, pre_dispatch='2*n_jobs', share_data=False,
+                 sampling='indices', backend=None, early_exit=False, oob_score=False):
         """
         sample_imbalance : optional, default = 1.0
             Number from 1.0 to 0.01.  Represents n_minority_class / n_majority_class in each Bag
@@ -81,6 +156,45 @@ class RepeatedRandomSubSampler(BaseEstimator, ClassifierMixin, MetaEstimatorMixi
         binary_thresh : optional, default = 0.5
             When voting = 'thresh', then use this to choose class 1 (of a binary classifier) when probability of class
             1 >= binary_thresh
+
+        share_data : optional, default = False
+            If True and X is dense, X and y are dumped once to memory-mapped files (see SharedDataset) and each
+            parallel fit is sent only a handle and its sample indices instead of a pickled copy of its rows
+
+        sampling : str, {'indices', 'weights'} (default = 'indices')
+            If 'indices', each sub-estimator is fit on a copy of its sampled rows, X[indices, :]
+            If 'weights', each sub-estimator is fit on the shared X with a 0/1 sample_weight mask selecting its rows,
+                so peak memory no longer grows with n_jobs * sample size.  base_estimator.fit must accept
+                sample_weight.  Fractional min_samples_split / min_samples_leaf are converted to row counts of the
+                sub-estimator's own sample before fitting (sklearn would use all of X), so trees match 'indices'.
+                class_weight='balanced' or 'balanced_subsample' (anywhere in base_estimator) raises a ValueError,
+                since sklearn would compute them over all of y.
+                Each fit still validates and passes over every row of X, so it trades fit time for memory
+
+        backend : str or None, optional, default = None
+            joblib backend used to fit and predict the sub-estimators ('threading' or 'multiprocessing'), joblib's
+            default if None.  Threads avoid copying X when the base_estimator releases the GIL (ie forests)
+            If 'shared_memory' (dense X), fit copies X, y once into multiprocessing.shared_memory (memory-mapped
+            files in /dev/shm before python 3.8, see SharedMemoryDataset) and n_jobs worker processes
+            (ProcessPoolExecutor) fit the sub-estimators on their index slices of it, for base estimators that hold
+            the GIL (ie SVC, Lasso).  Prediction then uses joblib's default backend.
+            A daemonic process (ie a multiprocessing worker of NestedCV.score / JRandomSearchCV with n_jobs > 1)
+            can't start the pool, so there fit warns and uses joblib's default backend: use 'shared_memory' when
+            the outer levels run with n_jobs=1 or the threading backend
+
+        early_exit : optional, default = False
+            When voting = 'thresh', predict evaluates the sub-estimators one after another and stops evaluating a row
+            as soon as the remaining sub-estimators can no longer move its mean probability across binary_thresh.
+            Same labels as the full average, cheaper when most rows are confidently one class.  Not used by
+            predict_proba, nor once compile_inference has been called
+
+        oob_score : optional, default = False
+            If True, fit computes out-of-bag probabilities for every training row, oob_decision_function_, and scores
+            them with pu_mix_assumed_f1beta10 as oob_score_ (labels from the decision rule of voting).  A majority
+            row is out-of-bag for every sub-estimator whose partition it is not in.  Every sub-estimator is trained
+            on all minority rows, so to get them out-of-bag the minority rows are split into one fold per
+            sub-estimator and sub-estimator i is trained without fold i, ie each sees (n-1)/n of the minority class.
+            That changes training slightly, so only use it for exploration
         """
         self.base_estimator = base_estimator
         self.sample_imbalance = sample_imbalance
@@ -90,6 +204,11 @@ class RepeatedRandomSubSampler(BaseEstimator, ClassifierMixin, MetaEstimatorMixi
         self.n_jobs = n_jobs
         self.pre_dispatch = pre_dispatch
         self.verbose = verbose
+        self.share_data = share_data
+        self.sampling = sampling
+        self.backend = backend
+        self.early_exit = early_exit
+        self.oob_score = oob_score
 
     def fit(self, X, y):
         random_state = check_random_state(self.random_state)
@@ -111,21 +230,138 @@ class RepeatedRandomSubSampler(BaseEstimator, ClassifierMixin, MetaEstimatorMixi
 
         # Store the classes seen during fit
         self.n_features_ = X.shape[1]
+        self.majority_class_ = np.argmax(np.bincount(y.astype(int)))
+        self._drop_engine()
         self.X_ = X
         self.y_ = y
 
+        samples_indices = self._generate_samples_indices(random_state, y)
+        if self.oob_score:
+            samples_indices = _hold_out_minority(random_state, y, self.majority_class_, samples_indices)
+        self.samples_indices_ = samples_indices
+        self.estimators_ = self._fit_estimators(base_estimator, X, y, samples_indices)
+        self.generation_ = 0
+        self.estimator_generations_ = [0] * len(self.estimators_)
+        if self.oob_score:
+            self._set_oob_score(X, y)
+
+        # Return the classifier
+        return self
+
+    def _generate_samples_indices(self, random_state, y):
         samples, last_sample = _generate_repeated_sample_indices(random_state, self.sample_imbalance, y, self.verbose)
         samples_indices = list(samples)
         samples_indices.extend([last_sample])
-        self.samples_indices_ = samples_indices
+        return samples_indices
+
+    def _fit_estimators(self, base_estimator, X, y, samples_indices):
+        """Fit a clone of base_estimator on the rows of every array of indices in samples_indices"""
+        parallel = Parallel(n_jobs=self.n_jobs, verbose=self.verbose, pre_dispatch=self.pre_dispatch,
+                            **self._backend_kwargs())
+        if self.sampling not in ('indices', 'weights'):
+            raise ValueError("sampling must be in ('indices', 'weights') NOT {}".format(self.sampling))
+        weighted = self.sampling == 'weights'
+        if weighted and not has_fit_parameter(base_estimator, 'sample_weight'):
+            raise ValueError("sampling='weights' requires base_estimator.fit to support sample_weight, {} does not"
+                             .format(base_estimator))
+        if weighted:
+            # 'balanced' class weights would be computed over all of y, zero weight rows included, not the sample
+            balanced = [name for name, value in base_estimator.get_params().items()
+                        if name.split('__')[-1] == 'class_weight' and value in ('balanced', 'balanced_subsample')]
+            if balanced:
+                raise ValueError("sampling='weights' doesn't support class_weight='balanced' or 'balanced_subsample' "
+                                 "({}), use sampling='indices'".format(', '.join(sorted(balanced))))
+        use_shared_memory = getattr(self, 'backend', None) == 'shared_memory'
+        if use_shared_memory and multiprocessing.current_process().daemon:
+            # ie fit inside a multiprocessing joblib worker of NestedCV / JRandomSearchCV, daemonic processes can't
+            # start a process pool
+            warnings.warn("backend='shared_memory' can't start worker processes from a daemonic process, fitting "
+                          "with joblib's default backend instead")
+            use_shared_memory = False
+        if use_shared_memory:
+            if issparse(X):
+                raise ValueError("backend='shared_memory' needs a dense X")
+            with SharedMemoryDataset(X, y) as shared:
+                with ProcessPoolExecutor(max_workers=_get_n_jobs(self.n_jobs)) as executor:
+                    futures = [executor.submit(_fit_shared_memory, clone(base_estimator), shared, indices, weighted)
+                               for indices in samples_indices]
+                    return [future.result() for future in futures]
+        if self.share_data and not issparse(X):
+            fit_fn = _parallel_fit_shared_weighted if weighted else _parallel_fit_shared
+            with SharedDataset(X, y) as shared:
+                return parallel(delayed(fit_fn)(clone(base_estimator), shared, indices)
+                                for indices in samples_indices)
+        if weighted:
+            # the same X is passed to every task: shared by threads, memory-mapped once by joblib for processes
+            return parallel(delayed(_parallel_fit_weighted)(clone(base_estimator), X, y, indices)
+                            for indices in samples_indices)
+        return parallel(delayed(_parallel_fit_base_estimator)(clone(base_estimator), X[indices,:], y[indices])
+                        for indices in samples_indices)
+
+    def update(self, X, y, max_age=None):
+        """Incrementally retrain with new data instead of refitting every sub-estimator.
+
+        X, y should hold the NEW majority class rows (ie this month's newly unlabeled members) plus the full, current
+        minority class (every positive, old and new).  The new majority rows are partitioned exactly as in fit and
+        a new sub-estimator is trained on every partition together with the refreshed minority rows, so each new
+        sub-estimator has the same sample_imbalance as the original ones.  Existing sub-estimators are kept unless
+        they are older than max_age updates.
+
+        Parameters
+        ----------
+        max_age : int or None, optional, default = None
+            Retire sub-estimators trained more than max_age updates ago (fit is update 0), so max_age=0 keeps only
+            the sub-estimators trained in this update.  If None keep all of them.
+
+        After an update, samples_indices_, X_ and y_ refer to the data passed to the latest update,
+        estimator_generations_[i] is the update estimators_[i] was trained in and generation_ is the latest update
+        """
+        check_is_fitted(self, 'estimators_')
+        X, y = check_X_y(X, y, accept_sparse=['csr', 'csc'])
+        if self.n_features_ != X.shape[1]:
+            raise ValueError("Number of features of the model must "
+                             "match the input. Model n_features is {0} and "
+                             "input n_features is {1}."
+                             "".format(self.n_features_, X.shape[1]))
+        if not np.array_equal(np.unique(y), self.classes_):
+            raise ValueError("y must contain both classes {} to update".format(self.classes_))
+        if np.argmax(np.bincount(y.astype(int))) != getattr(self, 'majority_class_', 0):
+            raise ValueError("y must have more majority class ({}) rows than minority class rows".format(
+                             getattr(self, 'majority_class_', 0)))
+
+        # models fit before update existed are generation 0
+        generation = getattr(self, 'generation_', 0) + 1
+        generations = list(getattr(self, 'estimator_generations_', [0] * len(self.estimators_)))
+
+        # a different, reproducible random state for every update
+        seeds = check_random_state(self.random_state).randint(MAX_INT, size=generation + 1)
+        random_state = np.random.RandomState(seeds[generation])
+        base_estimator = clone(self.base_estimator)
+        if ('random_state' in base_estimator.get_params().keys()):
+            base_estimator.set_params(random_state=random_state)
 
-        parallel = Parallel(n_jobs=self.n_jobs, verbose=self.verbose, pre_dispatch=self.pre_dispatch)
-        estimators = parallel(delayed(_parallel_fit_base_estimator)(clone(base_estimator), X[indices,:], y[indices])
-                       for indices in samples_indices)
+        samples_indices = self._generate_samples_indices(random_state, y)
+        new_estimators = self._fit_estimators(base_estimator, X, y, samples_indices)
 
-        self.estimators_ = estimators
+        estimators = list(self.estimators_) + list(new_estimators)
+        generations.extend([generation] * len(new_estimators))
+        if max_age is not None:
+            keep = [generation - g <= max_age for g in generations]
+            estimators = [est for est, k in zip(estimators, keep) if k]
+            generations = [g for g, k in zip(generations, keep) if k]
+            if self.verbose > 0:
+                print("retiring {} sub-estimators older than {} updates".format(keep.count(False), max_age))
 
-        # Return the classifier
+        self.estimators_ = estimators
+        self.estimator_generations_ = generations
+        self.generation_ = generation
+        self._drop_engine()
+        # the out-of-bag estimate described the old ensemble
+        for attr in ('oob_decision_function_', 'oob_score_'):
+            vars(self).pop(attr, None)
+        self.X_ = X
+        self.y_ = y
+        self.samples_indices_ = samples_indices
         return self
 
     def predict(self, X):
@@ -145,15 +381,19 @@ class RepeatedRandomSubSampler(BaseEstimator, ClassifierMixin, MetaEstimatorMixi
         if self.voting == 'soft':
             maj = np.argmax(self.predict_proba(X), axis=1)
         elif self.voting == 'hard':
-            predictions = Parallel(n_jobs=self.n_jobs, verbose=self.verbose, pre_dispatch=self.pre_dispatch)(
-            delayed(parallel_helper)(estimator, 'predict', X) for estimator in self.estimators_)
-            predictions = np.asarray(predictions)
-            maj = np.apply_along_axis(lambda x: np.argmax(np.bincount(x)), axis=0, arr=predictions)
+            # running per class vote counts, ties go to the lowest class like argmax(bincount)
+            votes = np.zeros((X.shape[0], len(self.classes_)), dtype=np.intp)
+            for prediction in self._iter_predictions('predict', X):
+                votes += np.asarray(prediction)[:, np.newaxis] == self.classes_
+            maj = np.argmax(votes, axis=1)
         elif self.voting == 'thresh':
             if not np.array_equal(self.classes_, [0, 1]):
                 raise ValueError("this classifier must be binary to support self.voting == 'thresh'")
-            probas = self.predict_proba(X)[:, -1]
-            maj = (probas >= self.binary_thresh).astype(int)
+            if getattr(self, 'early_exit', False) and self._get_engine() is None:
+                maj = self._predict_thresh_early_exit(X)
+            else:
+                probas = self.predict_proba(X)[:, -1]
+                maj = (probas >= self.binary_thresh).astype(int)
 
         return maj
 
@@ -170,22 +410,151 @@ class RepeatedRandomSubSampler(BaseEstimator, ClassifierMixin, MetaEstimatorMixi
                              "input n_features is {1}."
                              "".format(self.n_features_, X.shape[1]))
 
-        if hasattr(self.base_estimator, "predict_proba"):
-            predictions = Parallel(n_jobs=self.n_jobs, verbose=self.verbose, pre_dispatch=self.pre_dispatch)(
-                    delayed(parallel_helper)(estimator, 'predict_proba', X) for estimator in self.estimators_)
-            predictions = np.array(predictions)
+        engine = self._get_engine()
+        if engine is not None and self.voting in ('soft', 'thresh'):
+            return engine.predict_proba(X)
 
+        if hasattr(self.base_estimator, "predict_proba"):
+            # aggregate as each sub-estimator returns so memory stays O(n_samples), not O(n_estimators * n_samples)
+            n_classes = len(self.classes_)
             if self.voting in ('soft', 'thresh'):
-                return np.average(predictions, axis=0)
+                total = np.zeros((X.shape[0], n_classes), dtype=np.float64)
+                for proba in self._iter_predictions('predict_proba', X):
+                    total += proba
             elif self.voting == 'hard':
                 #take % of estimators >= 50%
-                maj = np.argmax(predictions, axis=2)
-                sums = np.apply_along_axis(lambda x: np.bincount(x, minlength=len(self.classes_)), axis=0, arr=maj)
-                tots = np.sum(sums, axis=0)
-                return np.transpose(sums / tots)
+                total = np.zeros((X.shape[0], n_classes), dtype=np.float64)
+                rows = np.arange(X.shape[0])
+                for proba in self._iter_predictions('predict_proba', X):
+                    total[rows, np.argmax(proba, axis=1)] += 1
+            return total / len(self.estimators_)
         else:
             raise AttributeError("predict_prob doesn't exist for: {}".format(self.base_estimator))
 
+    def _set_oob_score(self, X, y):
+        """Compute oob_decision_function_ (probabilities, or vote fractions for 'hard' voting, averaged over the
+        sub-estimators each row is out-of-bag for) and oob_score_ from the fitted estimators_ and samples_indices_"""
+        check_voting(self)
+        n_samples = X.shape[0]
+        n_jobs = _get_n_jobs(self.n_jobs)
+        total = np.zeros((n_samples, len(self.classes_)), dtype=np.float64)
+        counts = np.zeros(n_samples, dtype=np.intp)
+        pairs = list(zip(self.estimators_, self.samples_indices_))
+        with Parallel(n_jobs=n_jobs, verbose=self.verbose, **self._backend_kwargs()) as parallel:
+            for start in range(0, len(pairs), n_jobs):
+                for oob, proba in parallel(delayed(_parallel_oob_proba)(estimator, X, indices)
+                                           for estimator, indices in pairs[start:start + n_jobs]):
+                    if self.voting == 'hard':
+                        total[oob, np.argmax(proba, axis=1)] += 1
+                    else:
+                        total[oob] += proba
+                    counts[oob] += 1
+
+        has_oob = counts > 0
+        if not has_oob.all():
+            warnings.warn("{} rows are in the sample of every sub-estimator and have no out-of-bag prediction, "
+                          "their oob_decision_function_ is nan".format(np.sum(~has_oob)))
+        with np.errstate(invalid='ignore', divide='ignore'):
+            self.oob_decision_function_ = total / counts[:, np.newaxis]
+        y_pred = self._decide(self.oob_decision_function_[has_oob])
+        self.oob_score_ = pu_mix_assumed_f1beta10(np.asarray(y)[has_oob], y_pred)
+
+    def _decide(self, proba):
+        """Class labels from (averaged) probabilities with the decision rule of self.voting"""
+        if self.voting == 'thresh':
+            return (proba[:, -1] >= self.binary_thresh).astype(int)
+        return np.argmax(proba, axis=1)
+
+    def _predict_thresh_early_exit(self, X):
+        """'thresh' voting labels computed sub-estimator by sub-estimator, dropping rows once their label is fixed.
+
+        With n sub-estimators and probabilities in [0, 1], after k of them a row whose sum S_k >= n * binary_thresh
+        is class 1 even if the rest predict 0, and a row with S_k + (n - k) < n * binary_thresh is class 0 even if
+        the rest predict 1.  Only the undecided rows are passed to the next sub-estimator.
+        """
+        if issparse(X):
+            X = X.tocsr()
+        n = len(self.estimators_)
+        thresh_sum = n * self.binary_thresh
+        sums = np.zeros(X.shape[0], dtype=np.float64)
+        maj = np.zeros(X.shape[0], dtype=int)
+        active = np.arange(X.shape[0])
+        for k, estimator in enumerate(self.estimators_, 1):
+            if active.size == 0:
+                break
+            sums[active] += estimator.predict_proba(X[active])[:, -1]
+            active_sums = sums[active]
+            positive = active_sums >= thresh_sum
+            negative = active_sums + (n - k) < thresh_sum
+            maj[active[positive]] = 1
+            active = active[~(positive | negative)]
+            if self.verbose > 1:
+                print("after {} of {} sub-estimators {} rows are undecided".format(k, n, active.size))
+        return maj
+
+    def _backend_kwargs(self):
+        # only pass backend when set, so joblib keeps its own default (and older pickles without backend work)
+        backend = getattr(self, 'backend', None)
+        return {} if backend in (None, 'shared_memory') else {'backend': backend}
+
+    def _iter_predictions(self, method, X):
+        """Yield method(X) of every sub-estimator in order.  They are computed n_jobs at a time with one reused pool
+        of workers, so at most n_jobs outputs are held at once instead of one per sub-estimator"""
+        n_jobs = _get_n_jobs(self.n_jobs)
+        with Parallel(n_jobs=n_jobs, verbose=self.verbose, **self._backend_kwargs()) as parallel:
+            for start in range(0, len(self.estimators_), n_jobs):
+                batch = self.estimators_[start:start + n_jobs]
+                for prediction in parallel(delayed(parallel_helper)(estimator, method, X) for estimator in batch):
+                    yield prediction
+
+    def prune(self, X_val, y_val, tol=0.01, max_row_latency=None, prune_trees=False):
+        """Keep the fewest sub-estimators (and optionally trees of each forest) whose averaged validation
+        pu_mix_assumed_f1beta10 is within tol of the full ensemble, or that fit max_row_latency seconds per row.
+        See ensemblepruning.prune_ensemble, which also prunes a PNUWrapper using its threshold_.  Returns self"""
+        from .ensemblepruning import prune_ensemble
+        check_is_fitted(self, 'estimators_')
+        self.pruning_ = prune_ensemble(self, X_val, y_val, tol=tol, max_row_latency=max_row_latency,
+                                       prune_trees=prune_trees, verbose=self.verbose)
+        return self
+
+    def compile_inference(self, max_cells=2 ** 22):
+        """Merge the trees of every fitted sub-estimator (which must be forests or trees) into one CompiledForest
+        used by predict_proba (and predict) for 'soft' and 'thresh' voting.  It traverses a batch of rows through
+        all trees at once with vectorized numpy instead of calling predict_proba on every sub-estimator, and gives
+        the same averaged probabilities.  Refitting drops the compiled engine.
+
+        The engine is not pickled (it would store every tree twice), only max_cells is, and it is rebuilt from
+        estimators_ the first time an unpickled model predicts.
+
+        max_cells: rows * trees traversed per numpy step, see CompiledForest
+        """
+        check_is_fitted(self, 'estimators_')
+        check_voting(self)
+        if self.voting == 'hard':
+            raise ValueError("compile_inference only supports voting in ('soft', 'thresh')")
+        self.compiled_max_cells_ = max_cells
+        self.engine_ = CompiledForest.from_estimator(self, max_cells=max_cells)
+        return self
+
+    def _get_engine(self):
+        """The CompiledForest if compile_inference was called, rebuilt lazily after unpickling, else None"""
+        engine = getattr(self, 'engine_', None)
+        max_cells = getattr(self, 'compiled_max_cells_', None)
+        if engine is None and max_cells is not None:
+            engine = self.engine_ = CompiledForest.from_estimator(self, max_cells=max_cells)
+        return engine
+
+    def _drop_engine(self):
+        """Forget the compiled engine, ie after the sub-estimators changed"""
+        self.engine_ = None
+        self.compiled_max_cells_ = None
+
+    def __getstate__(self):
+        # the compiled engine duplicates every tree's nodes, _get_engine rebuilds it after loading
+        state = dict(super(RepeatedRandomSubSampler, self).__getstate__())
+        state.pop('engine_', None)
+        return state
+
     @property
     def feature_importances_(self):
         check_is_fitted(self, 'estimators_')
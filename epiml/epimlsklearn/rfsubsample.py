@@ -4,6 +4,7 @@
 Created on Sat Feb 18 23:11:24 2017
 """
 
+import queue
 import warnings
 from warnings import warn
 import numpy as np
@@ -15,7 +16,9 @@ from sklearn.utils import check_random_state, check_array, compute_sample_weight
 from sklearn.ensemble import RandomForestClassifier
 from sklearn.tree._tree import DTYPE, DOUBLE
 from sklearn.exceptions import DataConversionWarning
-from sklearn.utils.random import choice
+
+from .histtree import HistogramBinner, HistogramTreeClassifier
+from .epimlmetrics import pu_mix_assumed_f1beta10
 
 __all__ = ["RandomForestSubsample"]
 
@@ -24,11 +27,17 @@ MAX_INT = np.iinfo(np.int32).max
 def _generate_class_indices(y):
     return [np.where(y==c)[0] for c in np.unique(y)]
 
-def _generate_sample_indices(random_state, y, target_imbalance_ratio, verbose=0):
-    """Private function used to _parallel_build_trees function."""
+def _generate_sample_indices(random_state, y, target_imbalance_ratio, verbose=0, class_indices=None):
+    """Private function used to _parallel_build_trees function.
+
+    class_indices are the indices of every class in y (see _generate_class_indices), pass them to avoid scanning y
+    again for every tree.  The draws are the same as sklearn.utils.random.choice: a permutation of the majority class
+    for the subset, then a bootstrap of positions into [minority indices, majority subset], so a tree's random_state
+    still regenerates its indices.
+    """
     random_instance = check_random_state(random_state)
 
-    class_idxs = _generate_class_indices(y)
+    class_idxs = _generate_class_indices(y) if class_indices is None else class_indices
     class_len = [len(class_idx) for class_idx in class_idxs]
     minority_class_idx = np.argmin(class_len)
     majority_class_idx = np.argmax(class_len)
@@ -40,44 +49,84 @@ def _generate_sample_indices(random_state, y, target_imbalance_ratio, verbose=0)
               "n_samples:{}".format(len(y), target_imbalance_ratio, min_samples,
                          maj_samples, n_samples))
 
-    maj_indices = choice(class_idxs[majority_class_idx], size=maj_samples, replace=False, random_state=random_instance)
+    maj_pool = class_idxs[majority_class_idx]
+    if maj_samples > len(maj_pool):
+        raise ValueError("Cannot take a larger sample than population when 'replace=False'")
+    maj_indices = maj_pool[random_instance.permutation(len(maj_pool))[:maj_samples]]
     min_indices = class_idxs[minority_class_idx]
-    indices_to_choose_from = np.hstack((min_indices, maj_indices))
     if verbose > 99:
-        print("possible indicies to choose from: {}".format(indices_to_choose_from))
-
-    sample_indices = choice(indices_to_choose_from, size=n_samples, replace=True, random_state=random_instance)
+        print("possible indicies to choose from: {}".format(np.hstack((min_indices, maj_indices))))
+
+    # bootstrap positions into the minority indices followed by the majority subset, mapped without stacking them
+    positions = random_instance.randint(0, n_samples, size=n_samples)
+    is_min = positions < min_samples
+    sample_indices = np.empty(n_samples, dtype=maj_indices.dtype)
+    sample_indices[is_min] = min_indices[positions[is_min]]
+    sample_indices[~is_min] = maj_indices[positions[~is_min] - min_samples]
     if verbose > 99:
         print("chosen indicies: {}".format(sample_indices))
 
     return sample_indices
 
+def _balanced_subsample_weight(y_codes, indices, n_classes):
+    """Same as compute_sample_weight('balanced', y, indices) for a single output y encoded as class codes 0..n-1:
+    n_drawn / (n_classes_drawn * n_drawn_of_class), 0 for classes not drawn"""
+    drawn = bincount(y_codes[indices], minlength=n_classes)
+    present = drawn > 0
+    class_weight = np.zeros(n_classes, dtype=np.float64)
+    class_weight[present] = len(indices) / (np.sum(present) * drawn[present].astype(np.float64))
+    return class_weight[y_codes]
+
 def _parallel_build_trees(tree, forest, X, y, sample_weight, tree_idx, n_trees,
-                          verbose=0, class_weight=None, target_imbalance_ratio=None):
-    """Private function used to fit a single tree in parallel."""
+                          verbose=0, class_weight=None, target_imbalance_ratio=None, class_indices=None,
+                          binned=None, weight_buffers=None):
+    """Private function used to fit a single tree in parallel.
+
+    binned is (codes, bin_edges, y_codes) shared by every tree of a splitter='hist' forest, or None.
+    weight_buffers is a queue.Queue of float64 sample weight buffers of n_samples shared by the trees of a fit, a
+    tree takes one (or allocates it if all are in use) and puts it back once fit"""
     if verbose > 1:
         print("building tree %d of %d" % (tree_idx + 1, n_trees))
 
     if forest.bootstrap:
         n_samples = X.shape[0]
-        if sample_weight is None:
-            curr_sample_weight = np.ones((n_samples,), dtype=np.float64)
-        else:
-            curr_sample_weight = sample_weight.copy()
-
         indices = _generate_sample_indices(tree.random_state, y,
-                                           target_imbalance_ratio, verbose)
+                                           target_imbalance_ratio, verbose, class_indices)
         sample_counts = bincount(indices, minlength=n_samples)
-        curr_sample_weight *= sample_counts
+        if forest.oob_score:
+            # the in-bag rows as a bitset, n_samples / 8 bytes per tree
+            tree.in_bag_ = np.packbits(sample_counts > 0)
+        # the bootstrap counts are the weights, in a buffer reused by the next tree fit
+        curr_sample_weight = None
+        if weight_buffers is not None:
+            try:
+                curr_sample_weight = weight_buffers.get_nowait()
+            except queue.Empty:
+                pass
+        if curr_sample_weight is None:
+            curr_sample_weight = np.empty(n_samples, dtype=np.float64)
+        np.copyto(curr_sample_weight, sample_counts)
+        if sample_weight is not None:
+            curr_sample_weight *= sample_weight
 
         if class_weight == 'subsample':
             with warnings.catch_warnings():
                 warnings.simplefilter('ignore', DeprecationWarning)
                 curr_sample_weight *= compute_sample_weight('auto', y, indices)
         elif class_weight == 'balanced_subsample':
-            curr_sample_weight *= compute_sample_weight('balanced', y, indices)
+            if y.shape[1] == 1:
+                curr_sample_weight *= _balanced_subsample_weight(y[:, 0].astype(np.intp), indices,
+                                                                 forest.n_classes_[0])
+            else:
+                curr_sample_weight *= compute_sample_weight('balanced', y, indices)
 
-        tree.fit(X, y, sample_weight=curr_sample_weight, check_input=False)
+        if binned is not None:
+            codes, bin_edges, y_codes = binned
+            tree.fit_binned(codes, bin_edges, y_codes, forest.n_classes_[0], sample_weight=curr_sample_weight)
+        else:
+            tree.fit(X, y, sample_weight=curr_sample_weight, check_input=False)
+        if weight_buffers is not None:
+            weight_buffers.put(curr_sample_weight)
     else:
         tree.fit(X, y, sample_weight=sample_weight, check_input=False)
 
@@ -107,11 +156,24 @@ class RandomForestSubsample(RandomForestClassifier):
                  verbose=0,
                  warm_start=False,
                  class_weight=None,
-                 target_imbalance_ratio=1.0):
+                 target_imbalance_ratio=1.0,
+                 splitter='exact',
+                 max_bins=255):
         """ See RandomForestClassifier
         target_imbalance_ratio, optional, default = 1.0
             target ratio of minority class to majority class examples in each subsample
             Should be > 0.1 and <= 1.0
+        splitter, optional, default = 'exact'
+            'exact' fits sklearn DecisionTreeClassifiers.  'hist' bins every feature once per fit into at most
+            max_bins uint8 codes and grows HistogramTreeClassifiers level by level from histograms over the codes,
+            only scanning the rows each tree sampled.  Experimental, and short of the several times speedup it was
+            meant for: a tree fits about 1.3-1.7x faster than with 'exact' when its nodes stay large on 100k-400k
+            rows of flags and small counts (ie min_samples_split=0.02, min_samples_leaf=6), but 1.5-2.5x slower when
+            fully grown or fit on a few thousand rows, where per level numpy overhead dominates.  Its numpy code
+            also holds the GIL part of the time, so it gains less from n_jobs.  Splits of higher cardinality
+            features are limited to quantile bin edges.  Dense X, single output and max_leaf_nodes=None only
+        max_bins, optional, default = 255
+            maximum number of bins per feature for splitter='hist', at most 256
         """
 
         super(RandomForestSubsample, self).__init__(
@@ -133,6 +195,8 @@ class RandomForestSubsample(RandomForestClassifier):
                 class_weight=class_weight)
 
         self.target_imbalance_ratio = target_imbalance_ratio
+        self.splitter = splitter
+        self.max_bins = max_bins
 
 
     def fit(self, X, y, sample_weight=None):
@@ -210,6 +274,20 @@ class RandomForestSubsample(RandomForestClassifier):
             raise ValueError("Out of bag estimation only available"
                              " if bootstrap=True")
 
+        splitter = getattr(self, 'splitter', 'exact')
+        if splitter not in ('exact', 'hist'):
+            raise ValueError("splitter must be 'exact' or 'hist' NOT {}".format(splitter))
+        binned = None
+        if splitter == 'hist':
+            if issparse(X):
+                raise ValueError("splitter='hist' does not support sparse X")
+            if self.n_outputs_ != 1:
+                raise ValueError("splitter='hist' only supports a single output")
+            # bin once, every tree reuses the codes
+            binner = HistogramBinner(self.max_bins).fit(X)
+            binned = (binner.transform(X), binner.bin_edges_, y[:, 0].astype(np.intp))
+            self.base_estimator_ = HistogramTreeClassifier(max_bins=self.max_bins)
+
         random_state = check_random_state(self.random_state)
 
         if not self.warm_start:
@@ -242,12 +320,17 @@ class RandomForestSubsample(RandomForestClassifier):
             # for fitting the trees is internally releasing the Python GIL
             # making threading always more efficient than multiprocessing in
             # that case.
+            # the class indices are the same for every tree, find them once.  The draws stay per tree, since a
+            # tree's indices are regenerated from its random_state (see _in_bag), but the weight buffers are reused
+            class_indices = _generate_class_indices(y)
+            weight_buffers = queue.Queue()
             trees = Parallel(n_jobs=self.n_jobs, verbose=self.verbose,
                              backend="threading")(
                 delayed(_parallel_build_trees)(
                     t, self, X, y, sample_weight, i, len(trees),
                     verbose=self.verbose, class_weight=self.class_weight,
-                    target_imbalance_ratio=self.target_imbalance_ratio)
+                    target_imbalance_ratio=self.target_imbalance_ratio,
+                    class_indices=class_indices, binned=binned, weight_buffers=weight_buffers)
                 for i, t in enumerate(trees))
 
             # Collect newly grown trees
@@ -263,6 +346,59 @@ class RandomForestSubsample(RandomForestClassifier):
 
         return self
 
+    def _in_bag(self, tree, y, class_indices):
+        """Boolean mask of the rows tree was trained on, from its bitset or regenerated from its random_state"""
+        n_samples = y.shape[0]
+        if hasattr(tree, 'in_bag_'):
+            return np.unpackbits(tree.in_bag_)[:n_samples].astype(np.bool)
+        indices = _generate_sample_indices(tree.random_state, y, self.target_imbalance_ratio,
+                                           class_indices=class_indices)
+        in_bag = np.zeros(n_samples, dtype=np.bool)
+        in_bag[indices] = True
+        return in_bag
+
+    def _set_oob_score(self, X, y):
+        """Compute out-of-bag predictions from the imbalanced subsample each tree was really trained on (the parent
+        regenerates plain bootstraps).  Sets oob_decision_function_ (nan for rows in every tree's sample),
+        oob_score_ (accuracy, like RandomForestClassifier) and oob_pu_score_ (pu_mix_assumed_f1beta10 against the
+        labels fit on, see oob_pu_score to score against -1 / 0 / 1 labels)"""
+        if self.n_outputs_ != 1:
+            raise ValueError("RandomForestSubsample only supports oob_score with a single output")
+        X = check_array(X, dtype=DTYPE, accept_sparse='csr')
+        n_samples = y.shape[0]
+        n_classes = self.n_classes_[0] if isinstance(self.n_classes_, list) else self.n_classes_
+        predictions = np.zeros((n_samples, n_classes), dtype=np.float64)
+        n_predictions = np.zeros(n_samples, dtype=np.intp)
+        class_indices = _generate_class_indices(y)
+        for tree in self.estimators_:
+            oob = np.flatnonzero(~self._in_bag(tree, y, class_indices))
+            predictions[oob] += tree.predict_proba(X[oob, :], check_input=False)
+            n_predictions[oob] += 1
+
+        if (n_predictions == 0).any():
+            warn("Some inputs do not have OOB scores. "
+                 "This probably means too few trees were used "
+                 "to compute any reliable oob estimates.")
+        with np.errstate(invalid='ignore', divide='ignore'):
+            self.oob_decision_function_ = predictions / n_predictions[:, np.newaxis]
+        has_oob = n_predictions > 0
+        y_codes = y[:, 0]
+        y_pred_codes = np.argmax(predictions, axis=1)
+        self.oob_score_ = np.mean(y_codes[has_oob] == y_pred_codes[has_oob])
+        classes = self.classes_[0] if isinstance(self.classes_, list) else self.classes_
+        self.oob_pu_score_ = pu_mix_assumed_f1beta10(classes.take(y_codes[has_oob].astype(np.intp)),
+                                                     classes.take(y_pred_codes[has_oob]))
+
+    def oob_pu_score(self, y_true):
+        """pu_mix_assumed_f1beta10 of the out-of-bag predictions against y_true, the training rows' labels with -1
+        for unlabeled (ie before PNUWrapper assumed them negative).  Needs oob_score=True"""
+        if not hasattr(self, 'oob_decision_function_'):
+            raise AttributeError("oob_pu_score needs a RandomForestSubsample fit with oob_score=True")
+        y_true = np.asarray(y_true)
+        has_oob = ~np.isnan(self.oob_decision_function_[:, 0])
+        y_pred = self.classes_.take(np.argmax(self.oob_decision_function_[has_oob], axis=1))
+        return pu_mix_assumed_f1beta10(y_true[has_oob], y_pred)
+
 if __name__ == "__main__":
     from sklearn.datasets import make_classification
     np.set_printoptions(threshold=np.nan)
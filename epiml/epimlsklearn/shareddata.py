@@ -0,0 +1,177 @@
+# -*- coding: utf-8 -*-
+"""
+Helpers to share a training set with parallel workers without pickling it for every task
+"""
+
+import os
+import shutil
+import tempfile
+
+import numpy as np
+
+try:
+    from multiprocessing import shared_memory
+except ImportError:  # python < 3.8, SharedMemoryDataset uses memory-mapped files in RAM instead
+    shared_memory = None
+
+# shared blocks opened by this (worker) process, by name.  They stay mapped until the process exits: numpy arrays
+# over a block don't keep it from being closed, so closing it while a fitted estimator holds a view (ie X_) would
+# unmap memory still in use
+_attached_blocks = {}
+
+
+def _ram_folder():
+    """ /dev/shm if it exists (Linux), so memory-mapped files are backed by RAM, else the default temporary dir """
+    return '/dev/shm' if os.path.isdir('/dev/shm') else None
+
+
+class SharedDataset:
+    """ A handle to X, y dumped once to .npy files that workers open memory-mapped.
+
+    Only the file paths are pickled when the handle is sent to a worker, so dispatching hundreds of fit / score tasks
+    with process based parallelism no longer serializes the dataset once per task.  X must be a numeric array-like
+    (DataFrames are converted with np.asarray, so pipelines that need column names should not use this).
+
+    Use as a context manager, or call close(), to delete the files:
+
+        with SharedDataset(X, y) as data:
+            Parallel(n_jobs=4)(delayed(work)(data, train, test) for train, test in cv_iter)
+
+    and in the worker:
+
+        X, y = data.load()
+    """
+
+    def __init__(self, X, y=None, folder=None):
+        """
+        Parameters
+        ----------
+        X : array-like of shape [n_samples, n_features], numeric
+        y : array-like of shape [n_samples], optional
+        folder : str, optional, default=None
+            Directory to create the memory-mapped files in, a new temporary directory if None.  Use a local disk
+            (or /dev/shm) that every worker can see
+        """
+        X = np.asarray(X)
+        if X.dtype.kind not in 'biuf':
+            raise ValueError("SharedDataset only supports numeric X, not dtype {}".format(X.dtype))
+        self.folder = tempfile.mkdtemp(prefix='epiml_shared_', dir=folder)
+        self.X_path = os.path.join(self.folder, 'X.npy')
+        np.save(self.X_path, X)
+        if y is None:
+            self.y_path = None
+        else:
+            self.y_path = os.path.join(self.folder, 'y.npy')
+            np.save(self.y_path, np.asarray(y))
+        self.shape = X.shape
+
+    def load(self):
+        """ Return X, y as read-only memory-mapped arrays, y is None if it was not given """
+        X = np.load(self.X_path, mmap_mode='r')
+        y = None if self.y_path is None else np.load(self.y_path, mmap_mode='r')
+        return X, y
+
+    def close(self):
+        """ Delete the memory-mapped files """
+        shutil.rmtree(self.folder, ignore_errors=True)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def __len__(self):
+        return self.shape[0]
+
+
+class SharedMemoryDataset:
+    """ Like SharedDataset, but X, y are copied once into multiprocessing.shared_memory blocks instead of files, for
+    process pools (ie concurrent.futures.ProcessPoolExecutor) that fit on index slices.  Before python 3.8 the
+    blocks are memory-mapped .npy files in /dev/shm (a SharedDataset), which also stay in RAM.
+
+    Only the block names (or file paths), shapes and dtypes are pickled when the handle is sent to a worker.  The
+    process that created it owns the blocks and must close() it (or use it as a context manager), after the pool
+    has shut down, to free them; workers call load() and detach() once the task is done:
+
+        with SharedMemoryDataset(X, y) as data:
+            with ProcessPoolExecutor(4) as executor:
+                results = list(executor.map(work, [data] * len(tasks), tasks))
+
+    and in the worker:
+
+        X, y = data.load()
+        ...
+        del X, y
+        data.detach()
+    """
+
+    def __init__(self, X, y=None):
+        X = np.ascontiguousarray(X)
+        if X.dtype.kind not in 'biuf':
+            raise ValueError("SharedMemoryDataset only supports numeric X, not dtype {}".format(X.dtype))
+        self._owner = True
+        self._blocks = []
+        self._specs = []
+        self._files = None
+        if shared_memory is None:
+            self._files = SharedDataset(X, y, folder=_ram_folder())
+        else:
+            self._specs.append(self._share(X))
+            if y is not None:
+                self._specs.append(self._share(np.ascontiguousarray(y)))
+        self.shape = X.shape
+
+    def _share(self, array):
+        block = shared_memory.SharedMemory(create=True, size=max(array.nbytes, 1))
+        np.ndarray(array.shape, dtype=array.dtype, buffer=block.buf)[...] = array
+        self._blocks.append(block)
+        return block.name, array.shape, array.dtype.str
+
+    def __getstate__(self):
+        return {'_specs': self._specs, '_files': self._files, 'shape': self.shape}
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._owner = False
+        self._blocks = []
+
+    def load(self):
+        """ Return X, y as arrays backed by the shared blocks (treat them as read-only), y is None if it was not
+        given """
+        if self._files is not None:
+            return self._files.load()
+        if not self._blocks:
+            for name, _, _ in self._specs:
+                if name not in _attached_blocks:
+                    _attached_blocks[name] = shared_memory.SharedMemory(name=name)
+                self._blocks.append(_attached_blocks[name])
+        arrays = [np.ndarray(shape, dtype=np.dtype(dtype), buffer=block.buf)
+                  for (_, shape, dtype), block in zip(self._specs, self._blocks)]
+        return arrays[0], (arrays[1] if len(arrays) > 1 else None)
+
+    def detach(self):
+        """ Drop this handle's references to the blocks.  The process keeps one mapping per block, reused by later
+        load() calls, until it exits (process pool workers exit when the pool shuts down), since arrays from load()
+        may outlive the task, ie as views kept by a fitted estimator """
+        if not self._owner:
+            self._blocks = []
+
+    def close(self):
+        """ Free the shared blocks, only the creating process does so """
+        if self._owner:
+            for block in self._blocks:
+                block.close()
+                block.unlink()
+            self._blocks = []
+            if self._files is not None:
+                self._files.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def __len__(self):
+        return self.shape[0]
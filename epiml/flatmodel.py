@@ -0,0 +1,112 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Export a fitted tree ensemble (ie model 6: LoadEpimlTransformer -> PNUWrapper -> RepeatedRandomSubSampler ->
+RandomForestClassifier) to a directory of flat numpy arrays that can be loaded memory-mapped.
+
+Loading a joblib pickle of model 6 means decompressing and unpickling thousands of sklearn tree objects.  A flat
+model is every tree's nodes concatenated into a few contiguous arrays (feature, threshold, children, leaf class
+probabilities) plus the transformer's column plan, so loading is a handful of np.load(mmap_mode='r') calls and
+several scoring processes on one machine share the same pages of the model.
+"""
+
+import copy
+import json
+import os
+import pickle
+
+import numpy as np
+
+from epiml.epimlsklearn.forestengine import CompiledForest, flatten_trees
+
+FLAT_MODEL_VERSION = 1
+_ARRAYS = ['feature', 'threshold', 'left', 'right', 'value', 'tree_offsets', 'tree_weights']
+
+
+def _decision_threshold(estimator):
+    """ Return the threshold where predict is predict_proba[:, -1] >= threshold for this binary model """
+    if getattr(estimator, 'threshold_', None) is not None:
+        # PNUWrapper calibrated on unlabeled data
+        return float(estimator.threshold_)
+    if getattr(estimator, 'voting', None) == 'thresh':
+        return float(estimator.binary_thresh)
+    if hasattr(estimator, 'base_estimator') and not hasattr(estimator, 'estimators_'):
+        return _decision_threshold(estimator.base_estimator)
+    # argmax of 2 classes, ties go to class 0
+    return float(np.nextafter(0.5, 1.0))
+
+def export_flat_model(clf, folder: str):
+    """ Write a fitted model to folder as flat arrays
+
+    Parameters:
+    ------------------
+    clf: a fitted Pipeline of (LoadEpimlTransformer, tree ensemble) like EpimlModel.clf, or just the tree ensemble.
+        The ensemble may be any nesting of PNUWrapper, RepeatedRandomSubSampler (soft or thresh voting) and
+        random forests / decision trees
+    folder: str, directory to write to, created if it does not exist
+    """
+    from sklearn.pipeline import Pipeline
+    transformer = None
+    model = clf
+    if isinstance(clf, Pipeline):
+        if len(clf.steps) != 2:
+            raise ValueError("Only a Pipeline of (transformer, model) can be flattened")
+        transformer, model = clf.steps[0][1], clf.steps[1][1]
+    os.makedirs(folder, exist_ok=True)
+    arrays = flatten_trees(model)
+    for name in _ARRAYS:
+        np.save(os.path.join(folder, name + '.npy'), arrays[name])
+    meta = {'version': FLAT_MODEL_VERSION,
+            'threshold': _decision_threshold(model),
+            'n_features': int(model.n_features_),
+            'n_classes': int(arrays['value'].shape[1])}
+    with open(os.path.join(folder, 'meta.json'), 'w') as f:
+        json.dump(meta, f)
+    if transformer is not None:
+        transformer = copy.copy(transformer)
+        transformer.output = 'numpy'
+        with open(os.path.join(folder, 'transformer.pkl'), 'wb') as f:
+            pickle.dump(transformer, f)
+
+def load_flat_model(folder: str, mmap_mode='r'):
+    """ Load a model written by export_flat_model, memory-mapped by default """
+    return FlatModel(folder, mmap_mode=mmap_mode)
+
+
+class FlatModel:
+    """ A tree ensemble loaded from flat arrays, predicts the same probabilities as the model it was exported from
+    """
+
+    def __init__(self, folder: str, mmap_mode='r'):
+        with open(os.path.join(folder, 'meta.json')) as f:
+            meta = json.load(f)
+        if meta['version'] != FLAT_MODEL_VERSION:
+            raise ValueError("Flat model version {} is not supported".format(meta['version']))
+        self.threshold = meta['threshold']
+        self.n_features = meta['n_features']
+        self.n_classes = meta['n_classes']
+        arrays = {name: np.load(os.path.join(folder, name + '.npy'), mmap_mode=mmap_mode) for name in _ARRAYS}
+        self.engine = CompiledForest(**arrays)
+        transformer_path = os.path.join(folder, 'transformer.pkl')
+        self.transformer = None
+        if os.path.exists(transformer_path):
+            with open(transformer_path, 'rb') as f:
+                self.transformer = pickle.load(f)
+
+    def _prepare(self, X):
+        if self.transformer is not None:
+            X = self.transformer.transform(X)
+        # trees split on float32 values, like sklearn
+        X = np.asarray(X, dtype=np.float32)
+        if X.ndim != 2 or X.shape[1] != self.n_features:
+            raise ValueError("Number of features of the model must match the input. Model n_features is {0} and "
+                             "input shape is {1}.".format(self.n_features, X.shape))
+        return X
+
+    def predict_proba(self, X):
+        """ X: DataFrame / array in the format the exported pipeline took, or already transformed if there was no
+        transformer """
+        return self.engine.predict_proba(self._prepare(X))
+
+    def predict(self, X):
+        return (self.predict_proba(X)[:, -1] >= self.threshold).astype(int)
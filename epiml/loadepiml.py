@@ -3,56 +3,310 @@ This will load data for the Epiml project and normalize it.
 Also some helper functions for loading and saving searches
 """
 
+import glob
+import hashlib
+import os
+import pickle
+import shutil
+import tempfile
+
+import numpy as np
 import pandas as pd
+import scipy.sparse as sp
 
 from sklearn.exceptions import NotFittedError, ChangedBehaviorWarning
 from sklearn.externals import joblib
 
-def save_search(search, filename):
+from epiml.epimlsklearn.leanmodel import without_training_data
+
+def save_search(search, filename, lean=False):
     """
     Save a search to disk in a pickle file using joblib
+    If lean, the training data copies kept by every fitted PNUWrapper / RepeatedRandomSubSampler are left out
     """
-    joblib.dump(search, filename, compress=True)
+    if lean:
+        with without_training_data(search):
+            joblib.dump(search, filename, compress=True)
+    else:
+        joblib.dump(search, filename, compress=True)
 
 def load_search(filename):
     return joblib.load(filename)
 
+def downcast_frame(df: pd.DataFrame):
+    """
+    Downcast every numeric column of df, in place, to the narrowest dtype that holds its values.
+    Integer columns (mostly 0/1 claims flags and small counts) become int8/int16/int32 and float columns float32.
+    Non numeric columns are left alone.  Returns df
+    """
+    for col in df.columns:
+        kind = df[col].dtype.kind
+        if kind in 'iu':
+            df[col] = pd.to_numeric(df[col], downcast='integer')
+        elif kind == 'f':
+            df[col] = pd.to_numeric(df[col], downcast='float')
+    return df
+
+def iter_epiml_chunks(path, sep='\t', chunksize=100000, downcast=True):
+    """
+    Generator of DataFrames of chunksize rows each from a delimited Epiml file, downcast with downcast_frame unless
+    downcast is False
+    """
+    for chunk in pd.read_csv(path, sep=sep, low_memory=False, chunksize=chunksize):
+        yield downcast_frame(chunk) if downcast else chunk
+
+def _resolve_downcast(downcast, chunksize):
+    """ downcast=None means downcast when reading in chunks, as before the option existed """
+    return chunksize is not None if downcast is None else bool(downcast)
+
+def read_epiml_csv(path, sep='\t', chunksize=None, downcast=None):
+    """
+    Read a delimited Epiml file into a DataFrame
+
+    Parameters:
+    ------------
+    path: str,
+        passed into pd.read_csv, a file with delimited data
+    sep: str, optional, default='\t'
+        delimiter of the file, tab by default
+    chunksize: int, optional, default=None
+        If None, read the whole file at once.
+        If set, stream the file chunksize rows at a time, downcasting every chunk before concatenating them (see
+        downcast), so the full width int64 / float64 frame never has to exist in memory.
+    downcast: bool, optional, default=None
+        If True, numeric columns are downcast with downcast_frame (ie int8 flags and float32), if False they keep
+        pandas' default dtypes (int64 / float64).  None downcasts only when chunksize is set.
+    """
+    downcast = _resolve_downcast(downcast, chunksize)
+    if chunksize is None:
+        data = pd.read_csv(path, sep=sep, low_memory=False)
+        return downcast_frame(data) if downcast else data
+    chunks = list(iter_epiml_chunks(path, sep=sep, chunksize=chunksize, downcast=downcast))
+    # concat upcasts to the common type if chunks were downcast differently (ie int8 in one and int16 in another)
+    return pd.concat(chunks, ignore_index=True)
+
+def _cache_key(path, sep, downcast):
+    """
+    Key a parsed file by its absolute path, size and modification time along with the parse options that change
+    the resulting frame (sep and whether dtypes were downcast)
+    """
+    stat = os.stat(path)
+    key = "{}|{}|{}|{}|{}".format(os.path.abspath(path), stat.st_size, stat.st_mtime, sep, downcast)
+    return hashlib.sha1(key.encode('utf-8')).hexdigest()
+
+def _write_cache(data: pd.DataFrame, cache_path):
+    """
+    Write data as one .npy file per column plus a pickled list of column names into cache_path.
+    Written to a temporary directory first and renamed so a half written cache is never read
+    """
+    parent = os.path.dirname(cache_path)
+    os.makedirs(parent, exist_ok=True)
+    tmp_path = tempfile.mkdtemp(dir=parent)
+    try:
+        columns = list(data.columns)
+        for i, col in enumerate(columns):
+            values = data[col].values
+            np.save(os.path.join(tmp_path, "col_{}.npy".format(i)), values, allow_pickle=values.dtype == object)
+        with open(os.path.join(tmp_path, "columns.pkl"), 'wb') as f:
+            pickle.dump(columns, f)
+        os.rename(tmp_path, cache_path)
+    except OSError:
+        # another process may have written the same cache first, that copy is just as good
+        shutil.rmtree(tmp_path, ignore_errors=True)
+        if not os.path.isdir(cache_path):
+            raise
+
+def _read_cache(cache_path):
+    """
+    Read a frame written by _write_cache.  This is a fast binary reload, not a memory-mapped one: pandas consolidates
+    the columns into blocks, so every column is read into memory
+    """
+    with open(os.path.join(cache_path, "columns.pkl"), 'rb') as f:
+        columns = pickle.load(f)
+    data = {}
+    for i, col in enumerate(columns):
+        # object columns (ie Gender) are stored pickled
+        data[col] = np.load(os.path.join(cache_path, "col_{}.npy".format(i)), allow_pickle=True)
+    return pd.DataFrame(data, columns=columns)
+
+def _expand_paths(path):
+    """ Return a list of file paths from a single path, a glob pattern or a list of paths """
+    if isinstance(path, (list, tuple)):
+        return list(path)
+    if glob.has_magic(path):
+        paths = sorted(glob.glob(path))
+        if len(paths) == 0:
+            raise ValueError("No files match {}".format(path))
+        return paths
+    return [path]
+
+def _load_single(path, sep, chunksize, downcast, cache_dir):
+    """ Load one file, through the cache in cache_dir if it is set.  downcast must already be a bool """
+    if cache_dir is None:
+        return read_epiml_csv(path, sep=sep, chunksize=chunksize, downcast=downcast)
+    cache_path = os.path.join(cache_dir, _cache_key(path, sep, downcast))
+    if os.path.isdir(cache_path):
+        return _read_cache(cache_path)
+    data = read_epiml_csv(path, sep=sep, chunksize=chunksize, downcast=downcast)
+    _write_cache(data, cache_path)
+    return data
+
+def load_epiml_data(path, sep='\t', chunksize=None, cache_dir=None, n_jobs=1, downcast=None):
+    """
+    Load a delimited Epiml file (or set of files) with read_epiml_csv, optionally through an on-disk cache
+
+    Parameters:
+    ------------
+    path: str or list of str,
+        A file path, a glob pattern (ie "extracts/membership_*.txt") or a list of file paths.  Multiple files (one per
+        region / month for example) must have the same columns; each is parsed in its own process and the results
+        are concatenated, in sorted path order for a glob, into one frame
+    sep, chunksize, downcast: see read_epiml_csv, the same dtypes come out of one file or many.  Downcasting also
+        shrinks the shards sent back from the worker processes
+    cache_dir: str, optional, default=None
+        If set, the parsed frame is written once to a binary per-column .npy cache under this directory, keyed by
+        path, file size, modification time and parse options.  Later loads of the unchanged file read the cache
+        instead of re-parsing the delimited text.  Editing or replacing the file invalidates its cache entry.
+        Each file of a multi-file extract is cached separately.
+    n_jobs: int, optional, default=1
+        Number of processes used to parse multiple files, -1 for all cores
+    """
+    paths = _expand_paths(path)
+    downcast = _resolve_downcast(downcast, chunksize)
+    if len(paths) == 1:
+        return _load_single(paths[0], sep, chunksize, downcast, cache_dir)
+    shards = joblib.Parallel(n_jobs=n_jobs)(
+        joblib.delayed(_load_single)(shard_path, sep, chunksize, downcast, cache_dir) for shard_path in paths)
+    columns = shards[0].columns
+    for shard_path, shard in zip(paths, shards):
+        if set(shard.columns) != set(columns):
+            raise ValueError("{} has different columns than {}".format(shard_path, paths[0]))
+    # concat upcasts each column to the common type of the shards' dtypes if they were downcast differently
+    return pd.concat([shard[columns] for shard in shards], ignore_index=True)
+
+def _columns_to_csr(columns, shape):
+    """
+    Build a float32 csr_matrix of shape from an iterable of (output column index, 1d values), keeping only the
+    nonzero entries of each column so a dense float copy is never made
+    """
+    rows, cols, vals = [np.empty(0, dtype=np.intp)], [np.empty(0, dtype=np.int32)], [np.empty(0, dtype=np.float32)]
+    for j, values in columns:
+        nonzero = np.flatnonzero(values)
+        rows.append(nonzero)
+        cols.append(np.full(len(nonzero), j, dtype=np.int32))
+        vals.append(np.asarray(values[nonzero], dtype=np.float32))
+    coo = sp.coo_matrix((np.concatenate(vals), (np.concatenate(rows), np.concatenate(cols))),
+                        shape=shape, dtype=np.float32)
+    return coo.tocsr()
+
+def _frame_to_csr(X: pd.DataFrame):
+    """
+    Convert a numeric DataFrame to a float32 csr_matrix one column at a time so a dense float copy of X is never made
+    """
+    return _columns_to_csr(((j, X[col].values) for j, col in enumerate(X.columns)), X.shape)
+
+def _schema_hash(columns):
+    """ A stable (across processes, unlike hash()) fingerprint of an ordered list of column names """
+    return hashlib.sha1("\x1f".join(str(c) for c in columns).encode('utf-8')).hexdigest()
+
 class LoadEpimlTransformer:
     """Transforms a dataset by cleaning data, normalizing features, and dropping unused and unnecessary columns
 
     This class can be used as a scikit-learn transformer in a pipeline so that the data cleaning step is used
     consistently across training data and future patient data.
+
+    fit compiles a column plan (output column order, the integer index of each output's source column and a Gender
+    encoding table) so that transform is a single gather into a preallocated float32 array.
     """
 
-    def __init__(self):
+    def __init__(self, output='pandas'):
+        """
+        Parameters:
+        ------------
+        output: str, {'pandas', 'numpy', 'sparse'}, optional, default='pandas'
+            If 'pandas', transform returns a float32 DataFrame.
+            If 'numpy', transform returns the float32 np.ndarray without building a DataFrame around it
+            If 'sparse', transform returns a float32 scipy.sparse.csr_matrix with the same columns, which is much
+            smaller for the mostly zero claims flags and counts
+        """
+        if output not in ('pandas', 'numpy', 'sparse'):
+            raise ValueError("output must be in ('pandas', 'numpy', 'sparse') NOT {}".format(output))
+        self.output = output
         self.is_fit = False
         self._cols_to_drop = None
         self._unused_cols = None
         self._cols_to_binarize = None
         self._orig_col_headers = None
+        self._out_cols = None
+        self._col_sums = None
+        self._gender_seen = None
 
     def fit(self, X: pd.DataFrame, y = None):
         if self.is_fit:
             raise ChangedBehaviorWarning()
+        return self.partial_fit(X, y)
+
+    def partial_fit(self, X: pd.DataFrame, y = None):
+        """
+        Fit on X, or if already fit with partial_fit, update the fit with another chunk of rows from the same data.
+        Column sums (to find all zero columns) and Gender levels are accumulated chunk by chunk, so a file larger than
+        memory can be fit by calling partial_fit on each chunk (see fit_transformer_from_file).  The transformer can
+        be used to transform after any call.
+        """
+        if getattr(self, '_col_sums', None) is None:
+            self._orig_col_headers = X.columns.values
+            self._cols_to_binarize = ['Gender']
+            # drop all useless columns
+            self._unused_cols = ['unlabel_flag','true_pos_flag','true_neg_flag','MemberID','epi_related_cond',
+                              'epi_related_cond_subgrp','h_rank','pert_flag','mmos','elastase_flag',
+                              'medical_claim_count','rx_claim_count','CPT_FLAG44_Sum']
+            self._col_sums = pd.Series(dtype=np.float64)
+            self._gender_seen = set()
         else:
-            self.is_fit = True
-        X = X.copy()
-        self._orig_col_headers = X.columns.values
-        self._cols_to_binarize = ['Gender']
-        X = pd.get_dummies(X, columns=self._cols_to_binarize, drop_first=True)
-        # drop all useless columns
-        self._unused_cols = ['unlabel_flag','true_pos_flag','true_neg_flag','MemberID','epi_related_cond',
-                          'epi_related_cond_subgrp','h_rank','pert_flag','mmos','elastase_flag','medical_claim_count',
-                          'rx_claim_count','CPT_FLAG44_Sum']
-        X = X.drop(self._unused_cols, axis=1, errors='ignore')
-        X_sums = X.sum(numeric_only=True)
-        self._cols_to_drop = list(X_sums[X_sums == 0].index)
+            self._check_column_set(X)
+        self.is_fit = True
+
+        self._gender_seen.update(X['Gender'].dropna().unique())
+        X_sums = X.drop(self._unused_cols + self._cols_to_binarize, axis=1, errors='ignore').sum(numeric_only=True)
+        self._col_sums = self._col_sums.add(X_sums, fill_value=0)
+        self._cols_to_drop = list(self._col_sums[self._col_sums == 0].index)
+
+        # same column order as get_dummies would give, kept columns in original order then the Gender dummies
+        drop = set(self._cols_to_drop).union(self._unused_cols).union(self._cols_to_binarize)
+        gender_levels = sorted(self._gender_seen)
+        out_cols = [c for c in self._orig_col_headers if c not in drop]
+        out_cols.extend("{}_{}".format('Gender', level) for level in gender_levels[1:])
+        self._compile_plan(out_cols, gender_levels)
         return self
 
-    def transform(self, X):
-        if not self.is_fit:
-            raise NotFittedError("This LoadEpimlTransformer is not fitted yet")
-        X = X.copy()
+    def _compile_plan(self, out_cols, gender_levels):
+        """
+        Compile the column plan used by transform from the fitted output columns
+
+        out_cols: output column names in order, either an original column or a "Gender_<level>" dummy
+        gender_levels: sorted Gender levels seen in fit, the dummies get_dummies would create are for levels[1:]
+        """
+        headers = list(self._orig_col_headers)
+        header_idx = {c: i for i, c in enumerate(headers)}
+        dummy_levels = {"{}_{}".format('Gender', level): level for level in gender_levels[1:]}
+        src_idx, dst_idx, gender_levels_used, gender_dst = [], [], [], []
+        for dst, col in enumerate(out_cols):
+            if col in dummy_levels:
+                gender_levels_used.append(dummy_levels[col])
+                gender_dst.append(dst)
+            else:
+                src_idx.append(header_idx[col])
+                dst_idx.append(dst)
+        self._out_cols = np.asarray(out_cols, dtype=object)
+        self._plan_src = np.asarray(src_idx, dtype=np.intp)
+        self._plan_dst = np.asarray(dst_idx, dtype=np.intp)
+        self._gender_src = header_idx['Gender']
+        self._gender_levels = gender_levels_used
+        self._gender_dst = np.asarray(gender_dst, dtype=np.intp)
+        self._schema_hash = _schema_hash(headers)
+
+    def _check_column_set(self, X: pd.DataFrame):
+        """ Raise a ValueError if X's columns are not the fitted columns, ignoring unused columns """
         # add in self._unused_cols to the headers so that the error checks don't look for those columns
         X_cols = set(X.columns.values).union(self._unused_cols)
         data_cols = set(self._orig_col_headers).union(self._unused_cols)
@@ -61,14 +315,106 @@ class LoadEpimlTransformer:
             extra_cols = X_cols - data_cols
             raise ValueError("X missing {} cols [{}], and has {} extra cols [{}]".format(len(missing_cols),
                              missing_cols, len(extra_cols), extra_cols))
+
+    def _check_columns(self, X: pd.DataFrame):
+        """
+        Check X's columns with a precomputed hash of the fitted column order, falling back to _check_column_set.
+        Returns the position in X of every original column (-1 if it is an unused column missing from X)
+        """
+        if _schema_hash(X.columns.values) == self._schema_hash:
+            return np.arange(len(self._orig_col_headers))
+        self._check_column_set(X)
+        return X.columns.get_indexer(self._orig_col_headers)
+
+    def transform(self, X):
+        """
+        Parameters
+        ----------
+        X: pd.DataFrame with the columns the transformer was fit with (unused columns, ie the label flags, may be
+            left out) OR a 2d np.ndarray whose columns are in exactly the fitted column order (pandas-free path)
+
+        Returns
+        -------
+        float32 DataFrame, np.ndarray or csr_matrix depending on self.output
+        """
+        if not self.is_fit:
+            raise NotFittedError("This LoadEpimlTransformer is not fitted yet")
+        output = getattr(self, 'output', 'pandas')
+        if getattr(self, '_out_cols', None) is None:
+            # models pickled before the column plan existed
+            return self._transform_frame(X, output)
+
+        if isinstance(X, pd.DataFrame):
+            positions = self._check_columns(X)
+            column = lambda i: X.iloc[:, positions[i]].values
+        else:
+            X = np.asarray(X)
+            if X.ndim != 2 or X.shape[1] != len(self._orig_col_headers):
+                raise ValueError("X must have {} columns in the fitted order, it has shape {}".format(
+                                 len(self._orig_col_headers), X.shape))
+            column = lambda i: X[:, i]
+
+        if output == 'sparse':
+            # gather the nonzeros of one planned column at a time straight into the csr, no dense buffer
+            def planned_columns():
+                for src, dst in zip(self._plan_src, self._plan_dst):
+                    yield dst, column(src)
+                if len(self._gender_levels) > 0:
+                    gender = column(self._gender_src)
+                    for level, dst in zip(self._gender_levels, self._gender_dst):
+                        yield dst, gender == level
+            return _columns_to_csr(planned_columns(), (X.shape[0], len(self._out_cols)))
+
+        out = np.empty((X.shape[0], len(self._out_cols)), dtype=np.float32)
+        for src, dst in zip(self._plan_src, self._plan_dst):
+            out[:, dst] = column(src)
+        if len(self._gender_levels) > 0:
+            gender = column(self._gender_src)
+            for level, dst in zip(self._gender_levels, self._gender_dst):
+                out[:, dst] = gender == level
+
+        if output == 'numpy':
+            return out
+        return pd.DataFrame(out, columns=self._out_cols, index=X.index if isinstance(X, pd.DataFrame) else None)
+
+    def _transform_frame(self, X, output):
+        """ Transform without a compiled column plan """
+        X = X.copy()
+        self._check_column_set(X)
         #binar-i-tize data
         X = pd.get_dummies(X, columns=self._cols_to_binarize, drop_first=True)
         # drop columns
         X = X.drop(self._cols_to_drop, axis=1)
         X = X.drop(self._unused_cols, axis=1, errors='ignore')
+        if output == 'sparse':
+            return _frame_to_csr(X)
+        elif output == 'numpy':
+            return X.values.astype(np.float32)
         return X
 
 
+def fit_transformer_from_file(path, sep='\t', chunksize=100000, transformer=None):
+    """
+    Fit a LoadEpimlTransformer over a delimited Epiml file chunk by chunk with partial_fit, so the whole file never
+    has to be in memory.  Chunks can then be transformed with the returned transformer, for example:
+
+        transformer = fit_transformer_from_file(path)
+        for chunk in iter_epiml_chunks(path):
+            X = transformer.transform(chunk)
+
+    Parameters:
+    ------------
+    path, sep, chunksize: see iter_epiml_chunks
+    transformer: LoadEpimlTransformer, optional, default=None
+        an unfitted transformer to fit, if None a LoadEpimlTransformer() is created
+    """
+    if transformer is None:
+        transformer = LoadEpimlTransformer()
+    for chunk in iter_epiml_chunks(path, sep=sep, chunksize=chunksize):
+        transformer.partial_fit(chunk)
+    return transformer
+
+
 class LoadEpiml:
     """Manage loading a Epiml summarized dataset
     self.data = original data loaded in
@@ -79,19 +425,34 @@ class LoadEpiml:
         for future predictions of data not included in the original training data.
     """
 
-    def __init__(self, path, sep='\t', call_fit=True):
+    def __init__(self, path, sep='\t', call_fit=True, chunksize=None, cache_dir=None, output='pandas', n_jobs=1,
+                 downcast=None):
         """ Load data from file in path, will set up 'y' for unlabeled data = -1, 0 = negative, 1 = positive
 
         Parameters:
         ------------
-        path: str,
-            passed into pd.read_csv, a file with delimited data
+        path: str or list of str,
+            passed into pd.read_csv, a file with delimited data.  May also be a glob pattern or list of files with the
+            same columns which are loaded in parallel and concatenated (see load_epiml_data)
         sep: str, optional, default='\t'
             delimiter of the file, tab by default
         call_fit: Boolean, optional, default=True
             If true, will call fit right away with default argumants, if not, you must call fit separately
+        chunksize: int, optional, default=None
+            If set, stream the file in chunks of this many rows, downcasting columns to the narrowest dtype
+            that fits (see read_epiml_csv).  Use this for large membership files to reduce peak memory.
+        downcast: bool, optional, default=None
+            Whether self.data is downcast to the narrowest dtypes, for one file or many, chunked or not.  None
+            downcasts only when chunksize is set (see read_epiml_csv)
+        cache_dir: str, optional, default=None
+            If set, cache the parsed file under this directory and reuse it on later loads (see load_epiml_data)
+        output: str, {'pandas', 'numpy', 'sparse'}, optional, default='pandas'
+            passed to LoadEpimlTransformer, the type self.X and transform return
+        n_jobs: int, optional, default=1
+            Number of processes used to parse a multi-file path
         """
-        data = pd.read_csv(path, sep=sep, low_memory=False)
+        data = load_epiml_data(path, sep=sep, chunksize=chunksize, cache_dir=cache_dir, n_jobs=n_jobs,
+                               downcast=downcast)
 
         self.data = data
         self.X = None
@@ -99,7 +460,7 @@ class LoadEpiml:
         # -1 = unlabeled, 0 = true_negative, 1 = true_positive
         y = (self.data.unlabel_flag * -1) + self.data.true_pos_flag
         self.y = y
-        self.transformer = LoadEpimlTransformer()
+        self.transformer = LoadEpimlTransformer(output=output)
         if call_fit:
             self.fit(self.data, self.y)
 
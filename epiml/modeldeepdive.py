@@ -8,16 +8,11 @@ import pickle
 from collections import defaultdict
 from datetime import datetime
 
-import matplotlib.pyplot as plt
 import numpy as np
 import pandas as pd
-from lime.lime_tabular import LimeTabularExplainer
-from sklearn.model_selection import train_test_split
 from sklearn.calibration import calibration_curve
 
-from epiml.loadepiml import LoadEpiml
-from epiml.epimlsklearn.frankenscorer import FrankenScorer
-from epiml.bestmodels import generate_model_6
+# matplotlib, LIME and the model definitions are slow to import so they are imported where they are used
 
 
 class ModelDeepDive():
@@ -28,7 +23,7 @@ class ModelDeepDive():
         "RF - PNU Repeated Random Subsampling Random Searn.ipynb"
     """
 
-    def __init__(self, clf, explainer: LimeTabularExplainer, X_test: pd.DataFrame, y_test: pd.Series):
+    def __init__(self, clf, explainer: 'LimeTabularExplainer', X_test: pd.DataFrame, y_test: pd.Series):
         """
         Parameters:
         -------------------
@@ -167,6 +162,7 @@ class ModelDeepDive():
 
         Note: only uses labeled data to calibrate known examples.
         """
+        import matplotlib.pyplot as plt
         y_test_assumed = self.y_test.values.copy()
         labeled_mask = y_test_assumed != -1
         y_test_assumed = y_test_assumed[labeled_mask]
@@ -188,6 +184,7 @@ class ModelDeepDive():
         """ Generate a plot that shows the predicted probability with the y_test results of positive, negative, and
         unlabeled
         """
+        import matplotlib.pyplot as plt
         y_prob = pd.DataFrame(self.y_df.probas)
         y_prob.columns = ['pr_one']
         y_prob['label'] = self.y_test.values
@@ -272,12 +269,14 @@ class ModelDeepDive():
 
 ## BEST MODELS
 def create_model_6(X_train: pd.DataFrame, y_train: pd.DataFrame):
+    from epiml.bestmodels import generate_model_6
     pnu_test = generate_model_6()
     pnu_test.fit(X_train.values, y_train.values)
     return pnu_test
 
 #DREAM - fill in feature_names list of LimeTabularExplainer for more conherant explanations
 def create_explainer(X_train: pd.DataFrame, y_train: pd.DataFrame):
+    from lime.lime_tabular import LimeTabularExplainer
     return LimeTabularExplainer(X_train.values, feature_names=X_train.columns.values,
                                                   training_labels=y_train.values,
                                                   feature_selection='lasso_path', class_names=['No EPI', 'EPI'],
@@ -285,6 +284,10 @@ def create_explainer(X_train: pd.DataFrame, y_train: pd.DataFrame):
 
 #EXAMPLE RUN
 if __name__ == "__main__":
+    from lime.lime_tabular import LimeTabularExplainer
+    from sklearn.model_selection import train_test_split
+    from epiml.loadepiml import LoadEpiml
+    from epiml.epimlsklearn.frankenscorer import FrankenScorer
     path = "C:\Data\\010317\membership14_final_0103.txt"
     print("Loading {}".format(path))
     try:
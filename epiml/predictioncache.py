@@ -0,0 +1,101 @@
+# -*- coding: utf-8 -*-
+"""
+A persistent, size-bounded cache of predictions keyed by model and feature row.
+
+Most members' feature rows don't change between monthly extracts, so with a PredictionCache only new or changed rows
+are sent through the model (see EpimlModel.predict).  Entries are keyed by (model fingerprint, hash of the
+transformed feature row, optionally the member id) and stored in a sqlite database; when there are more than
+max_entries the least recently used are evicted.
+"""
+
+import hashlib
+import sqlite3
+import time
+
+import numpy as np
+from scipy.sparse import issparse
+
+_SQL_VARS = 500
+
+
+def model_fingerprint(clf):
+    """ A hash of a fitted model's pickled state, changes whenever the model is refit or updated """
+    from sklearn.externals import joblib
+    return joblib.hash(clf)
+
+def row_keys(X, ids=None):
+    """ Return a sha1 digest of every row of X (as float32, as the trees see it), also hashing ids[i] if given """
+    if issparse(X):
+        X = X.toarray()
+    X = np.ascontiguousarray(np.asarray(X, dtype=np.float32))
+    if ids is None:
+        return [hashlib.sha1(row.tobytes()).digest() for row in X]
+    return [hashlib.sha1(row.tobytes() + str(member_id).encode('utf-8')).digest() for row, member_id in zip(X, ids)]
+
+
+class PredictionCache:
+    """ sqlite backed (model, row) -> probability cache with least recently used eviction
+    """
+
+    def __init__(self, path: str, max_entries=50000000):
+        """
+        Parameters:
+        ---------------
+        path: str, file of the sqlite database, created if it does not exist
+        max_entries: int, optional, default=50000000
+            most predictions to keep, across all models
+        """
+        self.path = path
+        self.max_entries = max_entries
+        self._conn = sqlite3.connect(path)
+        with self._conn:
+            self._conn.execute("CREATE TABLE IF NOT EXISTS predictions (model TEXT NOT NULL, row_key BLOB NOT NULL, "
+                               "proba REAL NOT NULL, last_used REAL NOT NULL, UNIQUE (model, row_key))")
+            self._conn.execute("CREATE INDEX IF NOT EXISTS predictions_last_used ON predictions (last_used)")
+        # a running count of entries, so put doesn't scan the table; recounted exactly before evicting in case
+        # another process wrote to the same database
+        self._n_entries = len(self)
+
+    def get(self, model: str, keys):
+        """ Return an array of the cached probability for every key, NaN where it is not cached """
+        probas = np.full(len(keys), np.nan)
+        position = {key: i for i, key in enumerate(keys)}
+        found = []
+        for start in range(0, len(keys), _SQL_VARS):
+            batch = keys[start:start + _SQL_VARS]
+            sql = "SELECT row_key, proba FROM predictions WHERE model = ? AND row_key IN ({})".format(
+                ','.join('?' * len(batch)))
+            for row_key, proba in self._conn.execute(sql, [model] + list(batch)):
+                probas[position[bytes(row_key)]] = proba
+                found.append(row_key)
+        if len(found) > 0:
+            now = time.time()
+            with self._conn:
+                self._conn.executemany("UPDATE predictions SET last_used = ? WHERE model = ? AND row_key = ?",
+                                       ((now, model, row_key) for row_key in found))
+        return probas
+
+    def put(self, model: str, keys, probas):
+        """ Cache probas[i] for keys[i], then evict the least recently used entries above max_entries """
+        now = time.time()
+        rows = [(model, key, float(proba), now) for key, proba in zip(keys, probas)]
+        with self._conn:
+            # rowcount of the insert is the number of new entries, existing ones are then updated in place
+            n_new = self._conn.executemany("INSERT OR IGNORE INTO predictions (model, row_key, proba, last_used) "
+                                           "VALUES (?, ?, ?, ?)", rows).rowcount
+            if n_new < len(rows):
+                self._conn.executemany("UPDATE predictions SET proba = ?, last_used = ? WHERE model = ? AND "
+                                       "row_key = ?", ((proba, used, m, key) for m, key, proba, used in rows))
+            self._n_entries += n_new
+            if self._n_entries > self.max_entries:
+                self._n_entries = len(self)
+            if self._n_entries > self.max_entries:
+                self._n_entries -= self._conn.execute(
+                    "DELETE FROM predictions WHERE rowid IN (SELECT rowid FROM predictions ORDER BY last_used "
+                    "LIMIT ?)", (self._n_entries - self.max_entries,)).rowcount
+
+    def __len__(self):
+        return self._conn.execute("SELECT COUNT(*) FROM predictions").fetchone()[0]
+
+    def close(self):
+        self._conn.close()
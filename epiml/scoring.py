@@ -0,0 +1,38 @@
+# -*- coding: utf-8 -*-
+"""
+Minimal scoring-only entry point for short-lived batch scoring jobs.
+
+Importing this module only imports the standard library; numpy, pandas and the model code are imported when a model
+is loaded, and a flat model (see epiml.flatmodel) needs nothing beyond numpy, pandas and the transformer to score:
+
+    from epiml.scoring import load_scorer, score
+    scorer = load_scorer("model6_flat")     # a folder from EpimlModel.save_flat_model, or a joblib pickle
+    probas = score(scorer, X)
+"""
+
+import os
+
+
+def load_scorer(path: str, mmap_mode='r'):
+    """ Load a model to score with
+
+    Parameters:
+    ---------------
+    path: str,
+        a folder written by EpimlModel.save_flat_model / flatmodel.export_flat_model (loaded memory-mapped), or a
+        model file written by EpimlModel.save_model / save_clf
+    mmap_mode: passed to np.load for flat models
+
+    Returns:
+    ---------------
+    an object with predict_proba and predict
+    """
+    if os.path.isdir(path):
+        from epiml.flatmodel import load_flat_model
+        return load_flat_model(path, mmap_mode=mmap_mode)
+    from sklearn.externals import joblib
+    return joblib.load(path)
+
+def score(scorer, X):
+    """ Return the probability of EPI for every row of X """
+    return scorer.predict_proba(X)[:, -1]
@@ -0,0 +1,254 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+A small local HTTP service that loads a saved EpimlModel once and scores members on demand.
+
+Concurrent requests are coalesced into micro-batches (up to max_batch_size rows, waiting at most max_wait seconds
+for a batch to fill) before being sent through the model's pipeline, since a call into model 6 costs about the same
+for one row as for a thousand.  Only the standard library, numpy and pandas are used, and it binds to localhost by
+default:
+
+    python -m epiml.scoringservice model.pkl --port 8080
+
+    POST /score   body: JSON list of row objects (or {"rows": [...]}), or CSV text with Content-Type: text/csv
+                  returns: {"probability": [...]} plus "MemberID": [...] if the rows had a MemberID column
+    GET /health   returns: {"status": "ok"}
+"""
+
+import argparse
+import asyncio
+import io
+import json
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import pandas as pd
+
+from epiml.epimlmain import EpimlModel
+
+
+class MicroBatcher:
+    """ Coalesce DataFrames of rows submitted concurrently into batches for one predict_proba call each
+    """
+
+    def __init__(self, clf, max_batch_size=1024, max_wait=0.01, n_workers=1):
+        """
+        Parameters:
+        ---------------
+        clf: fitted classifier or pipeline with predict_proba, ie EpimlModel.clf
+        max_batch_size: int, optional, default=1024
+            a batch is scored as soon as it has at least this many rows
+        max_wait: float, optional, default=0.01
+            seconds to wait after the first request of a batch for more requests before scoring it
+        n_workers: int, optional, default=1
+            number of batches scored at the same time (in threads)
+
+        Must be created in the thread that runs the event loop
+        """
+        self.clf = clf
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait
+        self.loop = asyncio.get_event_loop()
+        self._executor = ThreadPoolExecutor(max_workers=n_workers)
+        self._slots = asyncio.Semaphore(n_workers)
+        self._queue = asyncio.Queue()
+        self._task = None
+        # the pipeline's LoadEpimlTransformer, used to reject rows with the wrong columns before they are batched
+        steps = [step for _, step in getattr(clf, 'steps', [])]
+        self._column_checker = next((step for step in steps if hasattr(step, '_check_column_set')), None)
+
+    def check(self, X: pd.DataFrame):
+        """ Raise a ValueError if X does not have the columns the model was fit with, so one bad request can't fail
+        the batch it would be scored in """
+        if self._column_checker is not None:
+            self._column_checker._check_column_set(X)
+
+    def start(self):
+        """ Start the batching loop on self.loop """
+        if self._task is None:
+            self._task = self.loop.create_task(self._run())
+        return self
+
+    async def score(self, X: pd.DataFrame):
+        """ Return the probability of EPI for every row of X once the batch X was added to is scored """
+        future = self.loop.create_future()
+        await self._queue.put((X, future))
+        return await future
+
+    async def _next_batch(self):
+        X, future = await self._queue.get()
+        batch = [(X, future)]
+        n_rows = len(X)
+        deadline = self.loop.time() + self.max_wait
+        while n_rows < self.max_batch_size:
+            timeout = deadline - self.loop.time()
+            if timeout <= 0:
+                break
+            try:
+                X, future = await asyncio.wait_for(self._queue.get(), timeout)
+            except asyncio.TimeoutError:
+                break
+            batch.append((X, future))
+            n_rows += len(X)
+        return batch
+
+    async def _run(self):
+        while True:
+            batch = await self._next_batch()
+            # at most n_workers batches are scored at once, the next batch keeps filling meanwhile
+            await self._slots.acquire()
+            self.loop.create_task(self._score_batch(batch))
+
+    async def _score_batch(self, batch):
+        """ Score one batch in the executor and resolve the futures of its requests """
+        frames = [X for X, _ in batch]
+        futures = [future for _, future in batch]
+        try:
+            try:
+                X = pd.concat(frames, ignore_index=True)
+                probas = await self.loop.run_in_executor(self._executor, self._predict, X)
+            except Exception as e:
+                if len(batch) == 1:
+                    self._set_exception(futures[0], e)
+                    return
+                # score every request on its own so only the offending ones fail
+                for X, future in batch:
+                    try:
+                        proba = await self.loop.run_in_executor(self._executor, self._predict, X)
+                    except Exception as frame_error:
+                        self._set_exception(future, frame_error)
+                    else:
+                        if not future.done():
+                            future.set_result(proba)
+                return
+            splits = np.cumsum([len(frame) for frame in frames])[:-1]
+            for future, proba in zip(futures, np.split(probas, splits)):
+                if not future.done():
+                    future.set_result(proba)
+        finally:
+            self._slots.release()
+
+    @staticmethod
+    def _set_exception(future, e):
+        if not future.done():
+            future.set_exception(e)
+
+    def _predict(self, X):
+        return self.clf.predict_proba(X)[:,-1]
+
+
+def _parse_rows(body: bytes, content_type: str):
+    """ Turn a request body into a DataFrame of rows to score """
+    text = body.decode('utf-8')
+    if content_type.startswith('text/csv'):
+        return pd.read_csv(io.StringIO(text))
+    rows = json.loads(text)
+    if isinstance(rows, dict):
+        rows = rows['rows']
+    if not isinstance(rows, list):
+        raise ValueError("JSON body must be a list of rows or {\"rows\": [...]}")
+    return pd.DataFrame(rows)
+
+
+class ScoringService:
+    """ asyncio HTTP/1.1 server (one request per connection) in front of a MicroBatcher
+    """
+
+    def __init__(self, batcher: MicroBatcher, id_col='MemberID', max_body_size=64 * 2 ** 20):
+        """ max_body_size: requests with a larger Content-Length (in bytes) are rejected with a 400 before their body
+        is read """
+        self.batcher = batcher
+        self.id_col = id_col
+        self.max_body_size = max_body_size
+
+    async def handle(self, reader, writer):
+        try:
+            request_line = await reader.readline()
+            parts = request_line.decode('latin-1').split()
+            if len(parts) < 2:
+                raise ValueError("malformed request line {!r}".format(request_line))
+            method, target = parts[0], parts[1]
+            headers = {}
+            while True:
+                line = await reader.readline()
+                if line in (b'\r\n', b'\n', b''):
+                    break
+                name, _, value = line.decode('latin-1').partition(':')
+                headers[name.strip().lower()] = value.strip()
+            content_length = int(headers.get('content-length', 0))
+            if not 0 <= content_length <= self.max_body_size:
+                raise ValueError("Content-Length must be between 0 and {} bytes".format(self.max_body_size))
+            body = await reader.readexactly(content_length)
+        except Exception as e:
+            status, payload = 400, {'error': str(e)}
+        else:
+            try:
+                status, payload = await self.route(method, target, headers, body)
+            except Exception as e:
+                # the request was valid, the model or server failed
+                status, payload = 500, {'error': str(e)}
+        self._respond(writer, status, payload)
+        try:
+            await writer.drain()
+        finally:
+            writer.close()
+
+    async def route(self, method, target, headers, body):
+        if method == 'GET' and target == '/health':
+            return 200, {'status': 'ok'}
+        if method == 'POST' and target == '/score':
+            try:
+                X = _parse_rows(body, headers.get('content-type', 'application/json'))
+                self.batcher.check(X)
+            except Exception as e:
+                return 400, {'error': str(e)}
+            probas = await self.batcher.score(X)
+            payload = {'probability': probas.tolist()}
+            if self.id_col in X.columns:
+                payload[self.id_col] = X[self.id_col].tolist()
+            return 200, payload
+        return 404, {'error': "unknown route {} {}".format(method, target)}
+
+    def _respond(self, writer, status, payload):
+        reasons = {200: 'OK', 400: 'Bad Request', 404: 'Not Found', 500: 'Internal Server Error'}
+        body = json.dumps(payload).encode('utf-8')
+        head = "HTTP/1.1 {} {}\r\nContent-Type: application/json\r\nContent-Length: {}\r\nConnection: close\r\n\r\n"
+        writer.write(head.format(status, reasons[status], len(body)).encode('latin-1'))
+        writer.write(body)
+
+
+def serve(model_path: str, host='127.0.0.1', port=8080, max_batch_size=1024, max_wait=0.01, n_workers=1,
+          id_col='MemberID', max_body_size=64 * 2 ** 20):
+    """ Load the model saved at model_path once and serve it until interrupted """
+    model = EpimlModel()
+    model.load_model(model_path)
+    loop = asyncio.get_event_loop()
+    batcher = MicroBatcher(model.clf, max_batch_size=max_batch_size, max_wait=max_wait,
+                           n_workers=n_workers).start()
+    service = ScoringService(batcher, id_col=id_col, max_body_size=max_body_size)
+    server = loop.run_until_complete(asyncio.start_server(service.handle, host, port))
+    print("Scoring {} on http://{}:{}".format(model_path, host, port))
+    try:
+        loop.run_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.close()
+        loop.run_until_complete(server.wait_closed())
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Serve a saved EpimlModel over local HTTP with micro-batching")
+    parser.add_argument('model_path', help="model saved with EpimlModel.save_model")
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8080)
+    parser.add_argument('--max-batch-size', type=int, default=1024, help="rows per batch before scoring")
+    parser.add_argument('--max-wait', type=float, default=0.01, help="seconds to wait for a batch to fill")
+    parser.add_argument('--n-workers', type=int, default=1, help="batches scored at the same time")
+    parser.add_argument('--id-col', default='MemberID')
+    parser.add_argument('--max-body-size', type=int, default=64 * 2 ** 20, help="largest request body in bytes")
+    args = parser.parse_args(argv)
+    serve(args.model_path, host=args.host, port=args.port, max_batch_size=args.max_batch_size,
+          max_wait=args.max_wait, n_workers=args.n_workers, id_col=args.id_col, max_body_size=args.max_body_size)
+
+if __name__ == "__main__":
+    main()
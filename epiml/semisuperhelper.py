@@ -4,9 +4,16 @@ Created on Mon Jan  2 00:03:11 2017
 
 """
 import numpy as np
+import scipy.sparse as sp
 from sklearn.utils import check_random_state
 from sklearn.utils.random import sample_without_replacement
 
+def _take_rows(X, mask):
+    """ Select the rows of X where mask is True, sparse matrices are indexed with integer row indices """
+    if sp.issparse(X):
+        return X[np.flatnonzero(mask)]
+    return X[mask]
+
 class SemiSupervisedHelper:
     """This class will provide helper functions for dealing with semi-supervised learning problems
         Unless otherwise stated, the convention for y is:
@@ -27,25 +34,25 @@ class SemiSupervisedHelper:
         """
         Return X_pn, y_pn
         """
-        return X[self.pn_mask], self.y[self.pn_mask]
+        return _take_rows(X, self.pn_mask), self.y[self.pn_mask]
 
     def pu(self, X):
         """
         Return X_pu, y_pu
         """
-        return X[self.pu_mask], self.y[self.pu_mask]
+        return _take_rows(X, self.pu_mask), self.y[self.pu_mask]
 
     def nu(self, X):
         """
         Return X_nu, y_nu
         """
-        return X[self.nu_mask], self.y[self.nu_mask]
+        return _take_rows(X, self.nu_mask), self.y[self.nu_mask]
 
     def u(self, X):
         """
         Return all unlabeled X_u, y_u
         """
-        return X[self.u_mask], self.y[self.u_mask]
+        return _take_rows(X, self.u_mask), self.y[self.u_mask]
 
     def pn_assume(self, X, unlabeled_to_class=0, unlabeled_pct=1.0):
         """
@@ -64,11 +71,14 @@ class SemiSupervisedHelper:
         rand_idx = sample_without_replacement(n_population = X_u_full.shape[0], n_samples=num_u, random_state=random_state)
         mask = np.zeros(X_u_full.shape[0], dtype=np.bool)
         mask[rand_idx] = True
-        X_u = X_u_full[mask, :]
-        X_u_unused = X_u_full[~mask, :]
+        X_u = _take_rows(X_u_full, mask)
+        X_u_unused = _take_rows(X_u_full, ~mask)
         y_u = np.full(num_u, unlabeled_to_class, dtype='int64')
 
-        X_ret = np.vstack((X_pn, X_u))
+        if sp.issparse(X_pn):
+            X_ret = sp.vstack((X_pn, X_u), format='csr')
+        else:
+            X_ret = np.vstack((X_pn, X_u))
         y_ret = np.concatenate((y_pn, y_u))
         return X_ret, y_ret, X_u_unused
 